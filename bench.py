@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+
+# Copyright (c) 2022, Qualcomm Innovation Center, Inc. All rights reserved.
+# SPDX-License-Identifier: GPL-2.0-or-later
+
+import ctypes
+import ctypes.util
+import os
+import subprocess
+import sys
+import time
+
+from src import syscalls
+
+
+def bench_syscall(loops: int = 100000) -> None:
+    """Compare the per-call overhead of a prebuilt prototype with setting "argtypes" on libc "syscall" every time."""
+    libc_syscall = ctypes.CDLL(name=ctypes.util.find_library('c'), use_errno=True).syscall
+    mode = ctypes.c_int()
+
+    start = time.perf_counter()
+    for _ in range(loops):
+        libc_syscall.argtypes = [ctypes.c_long, ctypes.POINTER(ctypes.c_int), ctypes.POINTER(ctypes.c_ulong),
+                                 ctypes.c_ulong, ctypes.c_void_p, ctypes.c_int]
+        libc_syscall.restype = ctypes.c_long
+        libc_syscall(syscalls.GET_MEMPOLICY.nr, ctypes.byref(mode), None, 0, None, 0)
+    shared = (time.perf_counter() - start) / loops
+
+    start = time.perf_counter()
+    for _ in range(loops):
+        syscalls.GET_MEMPOLICY(ctypes.byref(mode), None, 0, None, 0)
+    prebuilt = (time.perf_counter() - start) / loops
+
+    print(f'- get_mempolicy(): {shared * 1e9:.0f} ns per call with shared libc "syscall", '
+          f'{prebuilt * 1e9:.0f} ns per call prebuilt ({shared / prebuilt:.2f}x).')
+
+
+def time_command(command: list[str], loops: int) -> float:
+    """Return the fastest wall-clock time out of a few runs, which is the least noisy for startup costs."""
+    best = float('inf')
+    for _ in range(loops):
+        start = time.perf_counter()
+        subprocess.run(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, cwd=sys.path[0])
+        best = min(best, time.perf_counter() - start)
+
+    return best
+
+
+def bench_startup(loops: int = 10) -> None:
+    """Compare listing and running a single test case with the lazy registry against importing every module."""
+    lsbug = os.path.join(sys.path[0], 'lsbug.py')
+    eager = ('import importlib; from src import data; '
+             '[importlib.import_module(entry.module) for entry in data.Mapping.entries().values()]; '
+             'data.Mapping.show_all()')
+    lazy_list = time_command([sys.executable, lsbug, '-l'], loops)
+    eager_list = time_command([sys.executable, '-c', eager], loops)
+    print(f'- lsbug.py -l: {lazy_list * 1000:.1f} ms, {eager_list * 1000:.1f} ms importing every module '
+          f'({eager_list / lazy_list:.2f}x).')
+
+    single = time_command([sys.executable, lsbug, '-p', 'wakeup.seconds=0', 'run_wakeup'], loops)
+    print(f'- lsbug.py run_wakeup with no work: {single * 1000:.1f} ms.')
+
+
+def main() -> None:
+    bench_syscall()
+    bench_startup()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,15 +1,37 @@
 # Copyright (c) 2022, Qualcomm Innovation Center, Inc. All rights reserved.
 # SPDX-License-Identifier: GPL-2.0-or-later
 
+import array
+import ctypes
+import json
 import os
+import shutil
 import signal
 import subprocess
 import sys
 import tempfile
 import time
+import typing
+import xml.etree.ElementTree as ET
 
+import pytest
+
+from src import counters
+from src import data
+from src import history
+from src import journal
 from src import meta
+from src import numa
+from src import perf
+from src import sched
+from src import soak
+from src import stats
+from src import syscalls
+from src import trace
+from src import tree
 from src import utils
+from src import wakeup
+from src import worker
 
 
 class Lsbug:
@@ -50,6 +72,19 @@ def test_lsbug_negative():
     assert output == ''
 
 
+def test_lsbug_format():
+    output = subprocess.check_output([Lsbug().path, '-F', 'ndjson', '-f', '3'], stderr=subprocess.DEVNULL)
+    events = [json.loads(line) for line in output.splitlines()]
+    assert [event['event'] for event in events] == ['start', 'phase', 'phase', 'phase', 'finish', 'summary']
+    assert [event['phase'] for event in events[1:4]] == ['setup', 'run', 'cleanup']
+    assert events[4]['passed'] and events[5]['failed'] == 0
+    assert sorted(event['time'] for event in events) == [event['time'] for event in events]
+
+    output = subprocess.check_output([Lsbug().path, '-F', 'junit', '3'], stderr=subprocess.DEVNULL)
+    suite = ET.fromstring(output)
+    assert suite.get('tests') == '1' and suite.get('failures') == '0'
+
+
 def test_meta_watchdog():
     tc_pid = os.fork()
     if tc_pid == 0:
@@ -73,6 +108,58 @@ def test_meta_watchdog():
     assert os.WIFSIGNALED(status) and os.WTERMSIG(status) == signal.SIGTERM
 
 
+def test_meta_watchdog_escalate():
+    read_fd, write_fd = os.pipe()
+    tc_pid = os.fork()
+    if tc_pid == 0:
+        os.close(read_fd)
+        tc = meta.TestCase(timeout=10, run=lambda x: None, name='dummy', run_timeout=0.5)
+        wd = meta.Watchdog()
+        wd.grace = 0.5
+        wd.register(tc)
+
+        pid = os.fork()
+        if pid == 0:
+            # This is going to get killed anyway.
+            os.setpgid(0, 0)
+            signal.signal(signal.SIGTERM, signal.SIG_IGN)
+            while True:
+                os.write(write_fd, b'.')
+                time.sleep(0.1)
+
+        wd.add_pid(pid)
+        with wd.deadline((tc, 'run'), tc.run_timeout):
+            time.sleep(15)
+        sys.exit(os.EX_OK)
+
+    os.close(write_fd)
+    _, status = os.waitpid(tc_pid, 0)
+    assert os.WIFSIGNALED(status) and os.WTERMSIG(status) == signal.SIGTERM
+    # The writer is gone once we reach the EOF.
+    while os.read(read_fd, 4096):
+        pass
+    os.close(read_fd)
+
+
+def test_meta_supervisor():
+    def run(watchdog: meta.Watchdog) -> None:
+        for code in (0, 3):
+            pid = os.fork()
+            if pid == 0:
+                sum(range(1000000))
+                os._exit(code)
+
+            watchdog.add_child(pid)
+            if code == 0:
+                watchdog.del_child(pid)
+
+    result = meta.execute(meta.TestCase(timeout=10, run=run, name='dummy'), meta.Watchdog())
+    assert sorted(usage.exitcode for usage in result.children) == [0, 3]
+    assert all(usage.utime + usage.stime > 0 and usage.maxrss > 0 for usage in result.children)
+    # We can't know which one will exit first.
+    assert not result.passed and 'exited unexpectedly with 3' in result.error
+
+
 def test_lsbug_timeout():
     proc = subprocess.run([Lsbug().path, '-t', '0.01'])
     assert proc.returncode == -signal.SIGTERM
@@ -88,10 +175,68 @@ def test_lsbug_list() -> None:
 1       : Scale CPU up and down.
 2       : Read all PCIe sysfs files.
 3       : Allocate memory in a NUMA node.
+4       : Read all system sysfs files.
+5       : Read all class sysfs files.
+6       : Read all sysctl files.
+7       : Read all procfs files of a process.
+8       : Read PCIe sysfs files concurrently.
+9       : Scale all CPUs up and down.
+10      : Measure NUMA memory bandwidth.
+11      : Migrate pages between NUMA nodes.
+12      : Verify NUMA policy placement.
+13      : Fault in transparent huge pages.
+14      : Measure scheduler wake-up latency.
 """
     assert output == expect
 
 
+def test_numa_placement():
+    nodes = array.array('i', [0, 1, 1, 3, -14, 1])
+    assert list(numa.placement(nodes, 4)) == [1, 3, 0, 1, 1]
+
+
+def test_syscalls_get_mempolicy():
+    mode = ctypes.c_int(-1)
+    assert syscalls.GET_MEMPOLICY(ctypes.byref(mode), None, 0, None, 0) == 0
+    assert mode.value >= 0
+
+
+def test_counters():
+    with tempfile.TemporaryDirectory() as tmp:
+        files = {'vmstat': 'nr_free_pages 10\nthp_fault_alloc 3\n', 'ctrs': 'ref:100 del:200\n', 'freq': '1000\n'}
+        for name, content in files.items():
+            with open(os.path.join(tmp, name), 'w') as f:
+                f.write(content)
+
+        counter_set = counters.Counters()
+        counter_set.add('vmstat', os.path.join(tmp, 'vmstat'), keys=['thp_fault_alloc'])
+        counter_set.add('cpu0', os.path.join(tmp, 'ctrs'))
+        counter_set.add('cpu0.freq', os.path.join(tmp, 'freq'))
+        assert counter_set.names == ['vmstat.thp_fault_alloc', 'cpu0.ref', 'cpu0.del', 'cpu0.freq']
+        old = counter_set.snapshot()
+        assert list(old.values) == [3, 100, 200, 1000]
+
+        files = {'vmstat': 'nr_free_pages 9\nthp_fault_alloc 13\n', 'ctrs': 'ref:1100 del:2200\n', 'freq': '999\n'}
+        for name, content in files.items():
+            with open(os.path.join(tmp, name), 'w') as f:
+                f.write(content)
+        delta = counter_set.delta(old, counter_set.snapshot())
+        counter_set.close()
+        assert delta.as_dict() == {'vmstat.thp_fault_alloc': 10, 'cpu0.ref': 1000, 'cpu0.del': 2000, 'cpu0.freq': -1}
+        assert delta.rate('cpu0.ref') > 0
+
+
+def test_wakeup_find_outliers():
+    histograms = {}
+    for nr_cpu, ns in enumerate([1000, 2000, 1500, 900000, 50000]):
+        histograms[nr_cpu] = stats.Histogram()
+        histograms[nr_cpu].add(ns)
+    assert wakeup.find_outliers(histograms, factor=4, floor=100000) == [3]
+
+    histogram = wakeup.measure_wakeups(interval=100000, count=10)
+    assert histogram.count == 10
+
+
 def test_parse_range() -> None:
     assert utils.parse_range('1-3') == (1, 3)
     assert utils.parse_range('0-9') == (0, 9)
@@ -104,10 +249,48 @@ def test_merge_range() -> None:
     assert utils.merge_ranges(deny=['1-4'], allow=['2', '7', '8']) == [7, 8]
 
 
+def test_merge_range_select() -> None:
+    assert utils.merge_ranges(deny=['slow'], allow=['memory']) == [3, 12, 13]
+    assert utils.merge_ranges(deny=[], allow=['numa', 'run_cppc']) == [1, 3, 10, 11, 12]
+    with pytest.raises(RuntimeError):
+        utils.merge_ranges(deny=[], allow=['nothing'])
+
+
+def test_data_registry() -> None:
+    # The ast scan has to agree with what the decorators register.
+    for number, entry in data.Mapping.entries().items():
+        test_case = data.Mapping.get_test_case(number)
+        assert (test_case.name, test_case.tags) == (entry.name, entry.tags)
+        assert test_case.run.__name__ == entry.function
+    assert sorted(meta.cases) == list(data.Mapping.entries())
+
+    code = 'import sys; from src import data; data.Mapping.show_all(); assert "src.numa" not in sys.modules'
+    subprocess.check_call([sys.executable, '-c', code], cwd=sys.path[0], stdout=subprocess.DEVNULL)
+
+
+def test_utils_parse_cpulist():
+    assert utils.parse_cpulist('0-3,8,10-11\n') == [0, 1, 2, 3, 8, 10, 11]
+    assert utils.parse_cpulist('\n') == []
+
+
 def test_utils_tail_node():
     assert utils.tail_node() >= 0
 
 
+def test_utils_topology():
+    assert utils.to_mask([0, 3, 64]) == 1 << 64 | 0b1001
+    assert utils.from_mask(1 << 64 | 0b1001) == [0, 3, 64]
+
+    topology = utils.topology()
+    assert utils.topology() is topology
+    assert not topology.stale
+    for nr_cpu in topology.online_cpus:
+        assert topology.is_online(nr_cpu)
+        assert topology.node_cpus(topology.cpu_node(nr_cpu)) >> nr_cpu & 1
+        for level in ('core', 'cluster', 'package', 'cache'):
+            assert topology.siblings(nr_cpu, level) >> nr_cpu & 1
+
+
 def test_utils_double_dict():
     test_list = ['a', 'b', 'c', 'd']
     double_dict = utils.DoubleDict(test_list)
@@ -140,3 +323,173 @@ def test_utils_parse_pair_file():
 
     assert utils.parse_pair_file(file=file, sep=':') == dataset
     os.remove(file)
+
+
+def test_sched_resources():
+    f, file = tempfile.mkstemp(text=True)
+    os.close(f)
+
+    def record(name: str) -> typing.Callable[[meta.Watchdog], None]:
+        def run(watchdog: meta.Watchdog) -> None:
+            with open(file, 'a') as f:
+                f.write(f'{name} start\n')
+            time.sleep(0.2)
+            with open(file, 'a') as f:
+                f.write(f'{name} end\n')
+
+        return run
+
+    test_cases = [meta.TestCase(name=name, timeout=10, run=record(name), resources=frozenset(resources))
+                  for name, resources in (('a', {'x'}), ('b', {'x', 'y'}), ('c', set()))]
+    server = worker.ForkServer(test_cases)
+    scheduler = sched.Scheduler(jobs=3, watchdog=meta.Watchdog(), server=server)
+    scheduler.run(test_cases)
+    server.close()
+    assert not scheduler.failed
+
+    lines = open(file).read().splitlines()
+    os.remove(file)
+    # "a" and "b" share a resource, so they must not overlap.
+    assert lines.index('a end') < lines.index('b start')
+    assert lines.index('c start') < lines.index('a end')
+
+
+def test_worker_isolation():
+    def hang(watchdog: meta.Watchdog) -> None:
+        print('hang')
+        time.sleep(15)
+
+    def crash(watchdog: meta.Watchdog) -> None:
+        raise OSError('crash')
+
+    test_cases = [meta.TestCase(name='hang', timeout=1, run=hang), meta.TestCase(name='crash', timeout=10, run=crash),
+                  meta.TestCase(name='pass', timeout=10, run=lambda x: print('pass'))]
+    server = worker.ForkServer(test_cases)
+    results = [server.submit(test_case).wait() for test_case in test_cases[1:]]
+    proc = server.submit(test_cases[0])
+    proc.grace = 0
+    results.append(proc.wait())
+    server.close()
+
+    assert results[0].error == 'run: crash' and 'OSError: crash' in results[0].stderr
+    assert results[1].passed and results[1].stdout == 'pass\n' and set(results[1].phases) == {'setup', 'run', 'cleanup'}
+    assert not results[2].passed and results[2].stdout == 'hang\n'
+
+
+def test_perf_profiler():
+    profiler = perf.Profiler()
+    profiler.start()
+    buffer = bytearray(16 << 20)
+    with open('/proc/self/stat', 'rb') as f:
+        f.read()
+    costs = profiler.stop()
+    del buffer
+
+    assert costs['minflt'] > 0 and costs['io.rchar'] > 0
+    if 'task_clock_ms' in costs:
+        assert costs['task_clock_ms'] > 0 and costs['page_faults'] > 0
+
+
+def test_history_compare():
+    with tempfile.TemporaryDirectory() as tmp:
+        store = history.Store(tmp)
+        for index in range(6):
+            metrics = {'files': 100, 'cpus': {0: 1}}
+            store.add([meta.TestResult(name='a', phases={'run': 1 + index / 100}, metrics=metrics)])
+        assert len(store.history('a', 'metric.cpus.0')) == 6
+
+        assert store.compare([meta.TestResult(name='a', phases={'run': 1.02}, metrics={'files': 100})]) == []
+        regressions = store.compare([meta.TestResult(name='a', phases={'run': 3}, metrics={'files': 50})])
+        assert len(regressions) == 2 and 'phase.run' in regressions[0] and 'metric.files' in regressions[1]
+        # Getting faster is fine.
+        assert store.compare([meta.TestResult(name='a', phases={'run': 0.1})]) == []
+        store.close()
+
+
+def test_journal_recover():
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'journal')
+        cases = [meta.TestCase(name=name, timeout=0, run=lambda x: None) for name in ('a', 'b', 'c')]
+        run = journal.Journal(path)
+        run.start([test_case.name for test_case in cases], resume=False)
+        run.phase(cases[0], 'run')
+        run.finish(meta.TestResult(name='a'))
+        run.phase(cases[1], 'setup')
+        run.phase(cases[1], 'run')
+        # Die in the middle of writing a record.
+        os.write(run._fd, b'{"event": "ph')
+        os.close(run._fd)
+
+        run = journal.Journal(path)
+        assert run.recover() == ({'a'}, {'b': 'run'})
+        run.start(['b', 'c'], resume=True)
+        run.skip('b', quarantine=True)
+        run.close()
+        assert run.recover() == ({'a', 'b'}, {})
+        assert run.quarantined == {'b'}
+
+
+def test_soak_history():
+    history = soak.History(capacity=4)
+    for index in range(16):
+        result = meta.TestResult(name='a', phases={'setup': 0.1, 'run': 1 + index / 4, 'cleanup': 0.1})
+        if index == 3:
+            result.phases.pop('cleanup')
+            result.error = 'run: boom'
+        history.add(result)
+
+    assert (history.count, history.failures) == (16, 1)
+    assert len(history.phase('run')) == 16 and len(history.phase('cleanup')) == 15
+    assert len(history.totals()) == 15
+    assert history.drift() > 1
+
+
+def test_stats_histogram():
+    histogram = stats.Histogram()
+    for ns in range(1, 1001):
+        histogram.add(ns * 1000)
+    other = stats.Histogram()
+    other.add(5000000)
+    histogram.merge(other)
+
+    assert histogram.count == 1001 and histogram.max == 5000000
+    # A bucket's upper bound is at most twice as much.
+    assert 500000 <= histogram.percentile(50) <= 1000000
+    assert histogram.percentile(100) == 5000000
+    assert stats.percentile([3, 1, 2], 50) == 2
+
+
+def test_trace_ring():
+    tracer = trace.Tracer(capacity=4)
+    for index in range(6):
+        with tracer.span(f'span {index}'):
+            pass
+    tracer.merge([('child', 1, 2, 3, 3)])
+    assert tracer.dropped == 2
+
+    spans = tracer.export()
+    assert [span[0] for span in spans] == ['child', 'span 2', 'span 3', 'span 4', 'span 5']
+    assert all(begin <= end for _, begin, end, _, _ in spans)
+    assert spans[1][3] == os.getpid()
+    assert tracer.export() == []
+
+
+def test_tree_read_trees():
+    top = tempfile.mkdtemp()
+    os.makedirs(os.path.join(top, 'a', 'b'))
+    os.makedirs(os.path.join(top, 'skip'))
+    for file in ('a/1', 'a/b/2', 'skip/3'):
+        with open(os.path.join(top, file), 'w') as f:
+            f.write(file)
+    # Both point back to what we read anyway.
+    os.symlink(os.path.join(top, 'a'), os.path.join(top, 'link'))
+    os.symlink(top, os.path.join(top, 'a', 'b', 'loop'))
+
+    watchdog = meta.Watchdog()
+    tree.read_trees(spec=tree.TreeSpec(name='dummy', roots=(top,), skip=('skip',), follow=True), watchdog=watchdog)
+    assert watchdog.metrics['files'] == 2
+
+    matcher = tree.Matcher(tree.TreeSpec(name='dummy', roots=(), allow=(('*/x', 5),), skip=('*:*',)))
+    assert matcher.allow('/a/x', 5) and not matcher.allow('/a/x', 6) and not matcher.allow('/a/y', 5)
+    assert matcher.skip('0000:00') and not matcher.skip('power')
+    shutil.rmtree(top)
@@ -4,42 +4,182 @@
 # SPDX-License-Identifier: GPL-2.0-or-later
 
 import argparse
+import functools
+import os
+import sys
+import typing
 
 from src import data
+from src import history
+from src import journal
 from src import meta
+from src import perf
+from src import report
+from src import sched
+from src import soak
+from src import trace
 from src import utils
+from src import worker
 
 
 def parse_args() -> argparse.Namespace:
     parser = argparse.ArgumentParser(prog='lsbug.py')
     parser.add_argument('-l', '--list', action='store_true', help='List all test cases and their descriptions.')
-    parser.add_argument('-d', '--debug', action='store_true', help='Turn on the debugging output.')
+    parser.add_argument('-d', '--debug', action='store_true',
+                        help=('Turn on the debugging output, e.g., perf counters, I/O and resource usage of each '
+                              'phase, and a trace of where the time goes.'))
     parser.add_argument('-x', '--exclude', action='append',
-                        help='Exclude test cases by a number or range. It can be specified multiple times.')
+                        help='Exclude test cases like the positional arguments. It can be specified multiple times.')
     parser.add_argument('-t', '--timeout', type=float, help='number of seconds before killing the test run.')
+    parser.add_argument('-j', '--jobs', type=int,
+                        help='Run up to this many test cases at the same time unless they share resources.')
+    parser.add_argument('-p', '--param', action='append', metavar='NAME=VALUE',
+                        help='Tune a test case, e.g., pcie.slow_ms=100. It can be specified multiple times.')
+    parser.add_argument('-f', '--fork-server', action='store_true',
+                        help='Run each test case in an isolated worker, so a failure or timeout only affects itself.')
+    parser.add_argument('-F', '--format', choices=report.Reporter.formats,
+                        help='Write machine-readable results to the standard output, and everything else to the '
+                             'standard error. It exits non-zero on any failure.')
+    parser.add_argument('-H', '--history', metavar='DIR',
+                        help=f'Keep the results in a database under this directory, {history.DEFAULT_DIR} by default '
+                             'with --compare.')
+    parser.add_argument('-C', '--compare', action='store_true',
+                        help='Compare the results with the history of this host and kernel, and fail on regressions.')
+    parser.add_argument('-J', '--journal', metavar='FILE',
+                        help='Record the progress in this file, and sync it to disk before each phase.')
+    parser.add_argument('-R', '--resume', choices=('retry', 'skip', 'quarantine'),
+                        help=('Carry on with the run in the --journal file. Retry or skip the test case in flight when '
+                              'it ended, or quarantine it to skip it in every run with this journal.'))
+    parser.add_argument('-r', '--repeat', type=int,
+                        help='Run the test cases this many times, and summarize the timing.')
+    parser.add_argument('-D', '--duration', type=float,
+                        help='Run the test cases over and over for this many seconds, and summarize the timing.')
     parser.add_argument('test_cases', nargs='*', default=0,
-                        help=('Trigger test cases by numbers. They can be specified multiple times and used as a range,'
-                              ' e.g., 0-3'))
+                        help=('Trigger test cases by numbers, ranges like 0-3, tags like "memory", modules like "numa" '
+                              'or functions like "run_cppc". They can be specified multiple times.'))
 
     return parser.parse_args()
 
 
+def start_journal(test_cases: list[meta.TestCase], path: str, resume: typing.Optional[str]) -> list[meta.TestCase]:
+    """Return the test cases still to run, and record the progress from now on."""
+    meta.journal = journal.Journal(path)
+    skipped = meta.journal.quarantined
+    if resume:
+        done, in_flight = meta.journal.recover()
+        skipped |= done
+        print(f'- Resume the run with {len(done)} test cases done.')
+
+    names = [test_case.name for test_case in test_cases if test_case.name not in skipped]
+    meta.journal.start(names, resume=bool(resume))
+    for name in sorted(meta.journal.quarantined & {test_case.name for test_case in test_cases}):
+        print(f'- Skip the quarantined test case: {name}')
+
+    if resume:
+        for name, phase in in_flight.items():
+            print(f'- Test case "{name}" was in the {phase} phase when the last run ended.', file=sys.stderr)
+            if resume != 'retry':
+                meta.journal.skip(name, quarantine=resume == 'quarantine')
+                skipped.add(name)
+
+    return [test_case for test_case in test_cases if test_case.name not in skipped]
+
+
 def main() -> None:
     args = parse_args()
+    if args.resume and not args.journal:
+        raise RuntimeError('--resume needs a --journal file.')
+
     if args.list:
         data.Mapping.show_all()
         return
 
+    for item in args.param or []:
+        name, sep, value = item.partition('=')
+        if not sep:
+            raise RuntimeError(f'Unable to parse the parameter {item}.')
+        meta.params[name] = value
+
+    if args.debug:
+        meta.profiler = perf.Profiler()
+        trace.enable(meta.param('trace.spans', 1 << 16))
+
+    if args.format:
+        # Keep the standard output for the results alone.
+        sys.stdout.flush()
+        events_fd = os.dup(sys.stdout.fileno())
+        os.dup2(sys.stderr.fileno(), sys.stdout.fileno())
+        meta.reporter = report.Reporter(args.format, events_fd)
+
+    tc_allow = list(args.test_cases or [])
+    tc_deny = list(args.exclude or [])
+
+    test_list = utils.merge_ranges(deny=tc_deny, allow=tc_allow)
+    isolated = args.jobs or args.fork_server
+    soaking = args.repeat or args.duration
+    # The legacy loop below doesn't go through meta.execute(), which all the other modes rely on.
+    managed = isolated or soaking or args.debug or args.format or args.history or args.compare or args.journal
+    if managed:
+        test_cases = [test_case for test_num in test_list if (test_case := data.Mapping.get_test_case(test_num))]
+    if args.journal:
+        test_cases = start_journal(test_cases, args.journal, args.resume)
+    if isolated:
+        # This needs to happen before the watchdog starts any thread.
+        server = worker.ForkServer(test_cases)
+
     watchdog = meta.Watchdog()
     timeout = args.timeout or 0
     assert timeout >= 0
     test_run = meta.TestRun(timeout=timeout)
     watchdog.register(test_run)
 
-    tc_allow = list(args.test_cases or [])
-    tc_deny = list(args.exclude or [])
+    if managed:
+        if isolated:
+            watchdog.add_pid(server.pid)
+            scheduler = sched.Scheduler(jobs=args.jobs or 1, watchdog=watchdog, server=server)
+            one_pass = functools.partial(scheduler.run, test_cases)
+        else:
+            one_pass = functools.partial(soak.execute_all, test_cases, watchdog)
+        results = []
+
+        def run_pass() -> list[meta.TestResult]:
+            new_results = one_pass()
+            results.extend(new_results)
+            return new_results
+
+        if soaking:
+            soaker = soak.Soak(test_cases, repeat=args.repeat or 0, duration=args.duration or 0)
+            soaker.run(run_pass)
+            soaker.report()
+            failed = soaker.failed
+        else:
+            failed = any(not result.passed for result in run_pass())
+
+        if args.history or args.compare:
+            store = history.Store(args.history or history.DEFAULT_DIR)
+            if args.compare:
+                regressions = store.compare(results)
+                for regression in regressions:
+                    print(f'- Regression: {regression}.', file=sys.stderr)
+                failed = failed or bool(regressions)
+            store.add(results)
+            store.close()
+
+        if isolated:
+            server.close()
+            watchdog.del_pid(server.pid)
+        watchdog.unregister(test_run)
+        if meta.reporter:
+            meta.reporter.close()
+        if meta.journal:
+            meta.journal.close()
+        if args.debug:
+            path = meta.param('trace.path', 'lsbug-trace.json')
+            print(f'- Write {trace.write(path)} trace spans to {path}, which opens in Perfetto.')
+        if failed:
+            sys.exit(1)
+        return
 
-    test_list = utils.merge_ranges(deny=tc_deny, allow=tc_allow)
     for test_num in test_list:
         # We will need Python 3.8+ here.
         if not (test_case := data.Mapping.get_test_case(test_num)):
@@ -0,0 +1,94 @@
+# Copyright (c) 2022, Qualcomm Innovation Center, Inc. All rights reserved.
+# SPDX-License-Identifier: GPL-2.0-or-later
+
+from __future__ import annotations
+
+import array
+import dataclasses
+import operator
+import os
+import time
+import typing
+
+
+@dataclasses.dataclass(frozen=True)
+class Snapshot:
+    ns: int
+    values: array.array
+
+
+@dataclasses.dataclass(frozen=True)
+class Delta:
+    """How much every counter moved between two snapshots."""
+
+    index: dict[str, int]
+    values: array.array
+    seconds: float
+
+    def __getitem__(self, name: str) -> int:
+        return self.values[self.index[name]]
+
+    def rate(self, name: str) -> float:
+        """Return how much a counter moved per second."""
+        return self[name] / self.seconds if self.seconds else 0
+
+    def as_dict(self) -> dict[str, int]:
+        return dict(zip(self.index, self.values))
+
+
+class Counters:
+    """A declared set of counter files kept open, and captured together in one pass of pread() into an array.
+
+    A file either holds one number like "scaling_cur_freq", or pairs of a key and a number separated by spaces, colons
+    or newlines like "vmstat", "numastat" and "feedback_ctrs". We find the positions of the keys once, so a snapshot
+    only splits the content and converts the numbers we want.
+    """
+
+    def __init__(self) -> None:
+        self._index: dict[str, int] = {}
+        # (file descriptor, buffer size, positions of the numbers among all tokens)
+        self._files: list[tuple[int, int, list[int]]] = []
+
+    @property
+    def names(self) -> list[str]:
+        return list(self._index)
+
+    def add(self, name: str, path: str, keys: typing.Optional[list[str]] = None) -> None:
+        """Add the counters in a file as "name.key", or as "name" for a file with one number."""
+        fd = os.open(path, os.O_RDONLY)
+        content = os.read(fd, 1 << 20)
+        tokens = content.replace(b':', b' ').split()
+        if len(tokens) == 1:
+            names = [name]
+            positions = [0]
+        else:
+            fields = {tokens[index].decode(): index + 1 for index in range(0, len(tokens) - 1, 2)}
+            keys = keys or list(fields)
+            missing = [key for key in keys if key not in fields]
+            if missing:
+                os.close(fd)
+                raise OSError(f'No {missing} in {path}.')
+            names = [f'{name}.{key}' for key in keys]
+            positions = [fields[key] for key in keys]
+
+        for counter in names:
+            self._index[counter] = len(self._index)
+        # Leave room for the numbers to grow.
+        self._files.append((fd, len(content) + 4096, positions))
+
+    def snapshot(self) -> Snapshot:
+        values = array.array('q')
+        for fd, size, positions in self._files:
+            tokens = os.pread(fd, size, 0).replace(b':', b' ').split()
+            values.extend([int(tokens[position]) for position in positions])
+
+        return Snapshot(ns=time.monotonic_ns(), values=values)
+
+    def delta(self, old: Snapshot, new: Snapshot) -> Delta:
+        return Delta(index=self._index, values=array.array('q', map(operator.sub, new.values, old.values)),
+                     seconds=(new.ns - old.ns) / 1e9)
+
+    def close(self) -> None:
+        for fd, _, _ in self._files:
+            os.close(fd)
+        self._files.clear()
@@ -1,13 +1,17 @@
 # Copyright (c) 2022, Qualcomm Innovation Center, Inc. All rights reserved.
 # SPDX-License-Identifier: GPL-2.0-or-later
 
+import array
 import math
 import os
 import signal
 import sys
 import time
+import typing
 
+from src import counters
 from src import meta
+from src import trace
 from src import utils
 
 
@@ -74,52 +78,202 @@ def check_cppc(cppc: Cppc, top: bool = True) -> int:
     return int(cur_freq)
 
 
-def obtain_counters(file: str) -> tuple[int, int]:
-    line = open(file).read().rstrip()
-    reference, delivered = line.split()
+def cppc_domains(cpus: list[int]) -> list[int]:
+    """Return one CPU from each CPPC frequency domain, or all of them without such information."""
+    picks = []
+    covered = set()
+    for cpu in cpus:
+        if cpu in covered:
+            continue
 
-    return int(reference.lstrip('ref:')), int(delivered.lstrip('del:'))
+        picks.append(cpu)
+        freqdomain = os.path.join(Cppc(cpu).soft_path, 'freqdomain_cpus')
+        if os.path.exists(freqdomain):
+            covered.update(int(item) for item in open(freqdomain).read().split())
 
+    return picks
 
-def check_counters(cppc: Cppc, freq: int) -> None:
-    feedback_ctrs = os.path.join(cppc.hard_path, 'feedback_ctrs')
-    old_ref, old_del = obtain_counters(feedback_ctrs)
-    time.sleep(5)
-    new_ref, new_del = obtain_counters(feedback_ctrs)
 
-    reference_perf = int(open(os.path.join(cppc.hard_path, 'reference_perf')).read().rstrip())
-    scale = cppc.obtain_scale()
-    new_freq = 1000 * scale * reference_perf * (new_del - old_del) / (new_ref - old_ref)
+class FeedbackCounters:
+    """Keep all "feedback_ctrs" files open, so we can sample them in one batched pass."""
 
-    if not math.isclose(new_freq, freq, rel_tol=0.1):
-        print(f'- Error: average delivered performance is way off.', file=sys.stderr)
-        print(f'  new_ref: {new_ref}, new_del: {new_ref}', file=sys.stderr)
-        print(f'  old_ref: {old_ref}, old_del: {old_ref}', file=sys.stderr)
-        print(f'  reference_perf: {reference_perf}, scale: {scale}, new_freq: {new_freq}', file=sys.stderr)
-        raise OSError(f'The CPU is not running at {freq} kHz.')
+    def __init__(self, cppcs: list[Cppc]) -> None:
+        self._counters: counters.Counters = counters.Counters()
+        for cppc in cppcs:
+            self._counters.add(f'cpu{cppc.nr_cpu}', os.path.join(cppc.hard_path, 'feedback_ctrs'), keys=['ref', 'del'])
+        # Fold everything not changing into one factor per CPU: 1000 * scale * reference_perf.
+        self._factors: array.array = array.array('d', [
+            1000 * cppc.obtain_scale() * int(open(os.path.join(cppc.hard_path, 'reference_perf')).read())
+            for cppc in cppcs])
 
+    def sample(self) -> counters.Snapshot:
+        return self._counters.snapshot()
 
-def run_cppc(watchdog: meta.Watchdog) -> None:
-    cppc = Cppc(utils.tail_cpu())
-    print(f'- Only obtain information from CPU {cppc.nr_cpu}.')
-    min_freq = check_cppc(cppc=cppc, top=False)
+    def frequencies(self, old: counters.Snapshot, new: counters.Snapshot) -> array.array:
+        """Return the average delivered frequency of every CPU between two samples."""
+        delta = self._counters.delta(old, new).values
+        return array.array('d', [factor * dels / refs if refs else 0
+                                 for factor, refs, dels in zip(self._factors, delta[0::2], delta[1::2])])
+
+    def close(self) -> None:
+        self._counters.close()
+
+
+def find_outliers(cppcs: list[Cppc], freqs: array.array, top: bool) -> list[int]:
+    prefix = 'max' if top else 'min'
+    outliers = []
+    for cppc, freq in zip(cppcs, freqs):
+        expect = int(open(os.path.join(cppc.soft_path, f'cpuinfo_{prefix}_freq')).read())
+        if not math.isclose(freq, expect, rel_tol=0.1):
+            print(f'- Error: CPU {cppc.nr_cpu} delivers {freq:.0f} kHz instead of {expect} kHz.', file=sys.stderr)
+            outliers.append(cppc.nr_cpu)
+
+    return outliers
+
+
+class Sampler:
+    """Poll "scaling_cur_freq" and "feedback_ctrs" at a high rate with file descriptors kept open.
 
+    It stops as soon as the frequencies converge instead of sleeping for a fixed time, and keeps the time series.
+    """
+
+    def __init__(self, cppcs: list[Cppc], interval: float = 0.01) -> None:
+        self._cppcs: list[Cppc] = cppcs
+        self._interval: float = interval
+        self._freqs: counters.Counters = counters.Counters()
+        for cppc in cppcs:
+            self._freqs.add(f'cpu{cppc.nr_cpu}', os.path.join(cppc.soft_path, 'scaling_cur_freq'))
+        self._counters: FeedbackCounters = FeedbackCounters(cppcs)
+        # (seconds since the start, frequencies of all CPUs)
+        self._series: list[tuple[float, array.array]] = []
+        self._start: float = time.monotonic()
+
+    @property
+    def series(self) -> list[tuple[float, array.array]]:
+        return self._series
+
+    def cur_freqs(self) -> array.array:
+        freqs = self._freqs.snapshot().values
+        self._series.append((time.monotonic() - self._start, freqs))
+        return freqs
+
+    def wait_freqs(self, targets: list[int], timeout: float) -> typing.Optional[float]:
+        """Return how long it takes for all CPUs to reach the targets, or None if they don't."""
+        start = time.monotonic()
+        with trace.span('cppc.wait_freqs'):
+            while (elapsed := time.monotonic() - start) < timeout:
+                if list(self.cur_freqs()) == list(targets):
+                    return elapsed
+                time.sleep(self._interval)
+
+        return None
+
+    def wait_delivered(self, targets: list[int], timeout: float, window: float = 0.2,
+                       rel_tol: float = 0.1) -> tuple[typing.Optional[float], array.array]:
+        """Return how long it takes for the delivered frequencies to settle at the targets, and the last ones."""
+        start = time.monotonic()
+        old = self._counters.sample()
+        freqs = array.array('d')
+        while time.monotonic() - start < timeout:
+            # The counters are too coarse to be sampled as often as "scaling_cur_freq".
+            with trace.span('cppc.wait_delivered'):
+                time.sleep(window)
+            new = self._counters.sample()
+            freqs = self._counters.frequencies(old, new)
+            old = new
+            if all(math.isclose(freq, target, rel_tol=rel_tol) for freq, target in zip(freqs, targets)):
+                return time.monotonic() - start, freqs
+
+        return None, freqs
+
+    def close(self) -> None:
+        self._freqs.close()
+        self._counters.close()
+
+
+def spawn_load(watchdog: meta.Watchdog, nr_cpu: int) -> int:
     pid = os.fork()
     if pid == 0:
-        os.sched_setaffinity(os.getpid(), [cppc.nr_cpu])
+        # Lead a new process group, so the watchdog can kill it with anything it might leave behind.
+        os.setpgid(0, 0)
+        os.sched_setaffinity(os.getpid(), [nr_cpu])
         while True:
             pass
 
-    watchdog.add_pid(pid)
-    # it could take a while to scale up.
-    time.sleep(1)
-    max_freq = check_cppc(cppc=cppc)
+    watchdog.add_child(pid)
+    return pid
+
 
+# It needs otherwise idle CPUs, so it holds all of them.
+@meta.case(1, name='Scale CPU up and down.', timeout=30, tags=('cpu',), resources=('cpufreq', 'cpus'),
+           setup=setup_cppc)
+def run_cppc(watchdog: meta.Watchdog) -> None:
+    cppc = Cppc(utils.tail_cpu())
+    print(f'- Only obtain information from CPU {cppc.nr_cpu}.')
+    min_freq = check_cppc(cppc=cppc, top=False)
+    max_freq = int(open(os.path.join(cppc.soft_path, 'cpuinfo_max_freq')).read())
     assert max_freq > min_freq
-    check_counters(cppc=cppc, freq=max_freq)
+    sampler = Sampler([cppc])
 
+    load_begin = time.monotonic_ns()
+    pid = spawn_load(watchdog, cppc.nr_cpu)
+    # it could take a while to scale up.
+    ramp_up = sampler.wait_freqs([max_freq], timeout=5)
+    check_cppc(cppc=cppc)
+    settle, freqs = sampler.wait_delivered([max_freq], timeout=5)
+    if settle is None:
+        raise OSError(f'The CPU is running at {freqs[0]:.0f} kHz instead of {max_freq} kHz.')
+    print(f'- Time to peak: {ramp_up:.3f}s, and the delivered frequency settles in {settle:.3f}s.')
+
+    watchdog.del_child(pid)
     os.kill(pid, signal.SIGTERM)
+    # The busy loop can't report its own span, as it only ends by the signal.
+    trace.record(f'cppc.load on CPU {cppc.nr_cpu}', load_begin, time.monotonic_ns(), pid=pid)
     # It could take a bit more time to scale down.
-    time.sleep(5)
+    ramp_down = sampler.wait_freqs([min_freq], timeout=5)
     check_cppc(cppc=cppc, top=False)
-    check_counters(cppc=cppc, freq=min_freq)
+    settle, freqs = sampler.wait_delivered([min_freq], timeout=5)
+    if settle is None:
+        raise OSError(f'The CPU is running at {freqs[0]:.0f} kHz instead of {min_freq} kHz.')
+    print(f'- Time to idle: {ramp_down:.3f}s, and the delivered frequency settles in {settle:.3f}s.')
+    sampler.close()
+
+    watchdog.metrics['max_khz'] = max_freq
+    watchdog.metrics['min_khz'] = min_freq
+    watchdog.metrics['time_to_peak'] = ramp_up
+    watchdog.metrics['time_to_idle'] = ramp_down
+    watchdog.metrics['samples'] = len(sampler.series)
+
+
+@meta.case(9, name='Scale all CPUs up and down.', timeout=60, tags=('cpu', 'slow'),
+           resources=('cpufreq', 'cpus'), setup=setup_cppc)
+def run_cppc_all(watchdog: meta.Watchdog) -> None:
+    cppcs = [Cppc(cpu) for cpu in cppc_domains(utils.online_cpus())]
+    print(f'- Obtain information from {len(cppcs)} CPUs, one per frequency domain.')
+    max_freqs = [int(open(os.path.join(cppc.soft_path, 'cpuinfo_max_freq')).read()) for cppc in cppcs]
+    min_freqs = [int(open(os.path.join(cppc.soft_path, 'cpuinfo_min_freq')).read()) for cppc in cppcs]
+    sampler = Sampler(cppcs)
+
+    load_begin = time.monotonic_ns()
+    pids = [spawn_load(watchdog, cppc.nr_cpu) for cppc in cppcs]
+    # Carry on with the outliers, so we can report all of them.
+    ramp_up = sampler.wait_freqs(max_freqs, timeout=5)
+    _, peak = sampler.wait_delivered(max_freqs, timeout=5)
+    outliers = find_outliers(cppcs, peak, top=True)
+
+    for cppc, pid in zip(cppcs, pids):
+        watchdog.del_child(pid)
+        os.kill(pid, signal.SIGTERM)
+        trace.record(f'cppc.load on CPU {cppc.nr_cpu}', load_begin, time.monotonic_ns(), pid=pid)
+    ramp_down = sampler.wait_freqs(min_freqs, timeout=10)
+    _, idle = sampler.wait_delivered(min_freqs, timeout=5)
+    outliers += find_outliers(cppcs, idle, top=False)
+    sampler.close()
+    print(f'- Time to peak: {ramp_up}s, time to idle: {ramp_down}s.')
+
+    watchdog.metrics['time_to_peak'] = ramp_up
+    watchdog.metrics['time_to_idle'] = ramp_down
+    watchdog.metrics['peak_khz'] = dict(zip((cppc.nr_cpu for cppc in cppcs), peak))
+    watchdog.metrics['idle_khz'] = dict(zip((cppc.nr_cpu for cppc in cppcs), idle))
+    if outliers:
+        raise OSError(f'CPUs {sorted(set(outliers))} are not scaling as expected.')
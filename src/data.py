@@ -1,34 +1,90 @@
 # Copyright (c) 2022, Qualcomm Innovation Center, Inc. All rights reserved.
 # SPDX-License-Identifier: GPL-2.0-or-later
 
+from __future__ import annotations
+
+import ast
+import dataclasses
+import importlib
+import os
 import typing
 
-from src import cppc
 from src import meta
-from src import numa
-from src import pcie
+
+
+@dataclasses.dataclass(frozen=True)
+class Entry:
+    """What we know about a test case before importing its module."""
+
+    number: int
+    name: str
+    module: str
+    function: str
+    tags: frozenset[str]
+
+
+def scan_module(path: str) -> list[Entry]:
+    """Find all "@meta.case(...)" decorators in a module without importing it."""
+    with open(path) as f:
+        source = f.read()
+    # Most modules register nothing, so don't bother parsing them.
+    if '@meta.case(' not in source:
+        return []
+
+    module = 'src.' + os.path.basename(path)[:-len('.py')]
+    entries = []
+    for node in ast.parse(source, filename=path).body:
+        if not isinstance(node, ast.FunctionDef):
+            continue
+
+        for decorator in node.decorator_list:
+            if (isinstance(decorator, ast.Call) and isinstance(decorator.func, ast.Attribute) and
+                    decorator.func.attr == 'case' and isinstance(decorator.func.value, ast.Name) and
+                    decorator.func.value.id == 'meta'):
+                keywords = {keyword.arg: keyword.value for keyword in decorator.keywords}
+                entries.append(Entry(number=ast.literal_eval(decorator.args[0]),
+                                     name=ast.literal_eval(keywords['name']), module=module, function=node.name,
+                                     tags=frozenset(ast.literal_eval(keywords['tags'])) if 'tags' in keywords
+                                     else frozenset()))
+
+    return entries
 
 
 # This class will be alive for the program's whole life, so we don't need to create an instance of it.
 class Mapping:
-    _tc_map = {
-        1: meta.TestCase(setup=cppc.setup_cppc, run=cppc.run_cppc, timeout=30, name='Scale CPU up and down.'),
-        2: meta.TestCase(setup=pcie.check_pcie_sysfs, run=pcie.read_pcie_sysfs, timeout=30,
-                         name='Read all PCIe sysfs files.'),
-        3: meta.TestCase(setup=numa.check_numa_node, run=numa.allocate_numa_node, cleanup=numa.restore_numa_policy,
-                         timeout=30, name='Allocate memory in a NUMA node.')
-    }
+    _entries: typing.Optional[dict[int, Entry]] = None
+
+    @classmethod
+    def entries(cls) -> dict[int, Entry]:
+        if cls._entries is None:
+            src = os.path.dirname(os.path.abspath(__file__))
+            found = [entry for file in sorted(os.listdir(src)) if file.endswith('.py')
+                     for entry in scan_module(os.path.join(src, file))]
+            cls._entries = {entry.number: entry for entry in sorted(found, key=lambda entry: entry.number)}
+
+        return cls._entries
 
     @classmethod
     def show_all(cls) -> None:
-        for index, tc in cls._tc_map.items():
-            print(f'{index:<8}: {tc.name}')
+        for index, entry in cls.entries().items():
+            print(f'{index:<8}: {entry.name}')
 
     @classmethod
     def get_test_case(cls, num: int) -> typing.Optional[meta.TestCase]:
-        if num in cls._tc_map:
-            return cls._tc_map[num]
+        entry = cls.entries().get(num)
+        if entry is None:
+            return None
+
+        # Importing the module registers all of its test cases.
+        importlib.import_module(entry.module)
+        return meta.cases[num]
+
+    @classmethod
+    def select(cls, word: str) -> list[int]:
+        """Return the test cases with a tag, in a module or of a function, e.g., "memory", "numa" or "run_cppc"."""
+        return [number for number, entry in cls.entries().items()
+                if word in entry.tags or word in (entry.module[len('src.'):], entry.function)]
 
     @classmethod
     def get_total(cls) -> int:
-        return len(cls._tc_map)
+        return len(cls.entries())
@@ -0,0 +1,115 @@
+# Copyright (c) 2022, Qualcomm Innovation Center, Inc. All rights reserved.
+# SPDX-License-Identifier: GPL-2.0-or-later
+
+from __future__ import annotations
+
+import os
+import socket
+import sqlite3
+import statistics
+import time
+
+from src import meta
+
+DEFAULT_DIR = os.path.expanduser('~/.cache/lsbug')
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS results (
+    id INTEGER PRIMARY KEY,
+    run INTEGER NOT NULL,
+    started REAL NOT NULL,
+    host TEXT NOT NULL,
+    release TEXT NOT NULL,
+    boot_id TEXT NOT NULL,
+    name TEXT NOT NULL,
+    passed INTEGER NOT NULL,
+    error TEXT
+);
+CREATE INDEX IF NOT EXISTS results_key ON results (host, release, name);
+CREATE TABLE IF NOT EXISTS samples (
+    result INTEGER NOT NULL REFERENCES results (id),
+    name TEXT NOT NULL,
+    value REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS samples_key ON samples (result, name);
+"""
+
+
+def flatten(result: meta.TestResult) -> dict[str, float]:
+    """Return all numbers of a result like "phase.run", "metric.files" or "cost.run.page_faults"."""
+    samples = {f'phase.{phase}': seconds for phase, seconds in result.phases.items()}
+    for name, value in result.metrics.items():
+        items = value.items() if isinstance(value, dict) else [(None, value)]
+        for key, number in items:
+            if isinstance(number, (int, float)) and not isinstance(number, bool):
+                samples[f'metric.{name}' if key is None else f'metric.{name}.{key}'] = number
+    for phase, costs in result.costs.items():
+        for name, value in costs.items():
+            samples[f'cost.{phase}.{name}'] = value
+
+    return samples
+
+
+class Store:
+    """An append-only SQLite database of results keyed by host, kernel release, boot and test case."""
+
+    def __init__(self, directory: str) -> None:
+        os.makedirs(directory, exist_ok=True)
+        self._db: sqlite3.Connection = sqlite3.connect(os.path.join(directory, 'history.sqlite'))
+        self._db.executescript(SCHEMA)
+        self._host: str = socket.gethostname()
+        self._release: str = os.uname().release
+        self._boot_id: str = open('/proc/sys/kernel/random/boot_id').read().strip()
+
+    def add(self, results: list[meta.TestResult]) -> None:
+        with self._db:
+            run = self._db.execute('SELECT COALESCE(MAX(run), 0) + 1 FROM results').fetchone()[0]
+            for result in results:
+                cursor = self._db.execute(
+                    'INSERT INTO results (run, started, host, release, boot_id, name, passed, error) '
+                    'VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                    (run, time.time(), self._host, self._release, self._boot_id, result.name, result.passed,
+                     result.error))
+                self._db.executemany('INSERT INTO samples (result, name, value) VALUES (?, ?, ?)',
+                                     [(cursor.lastrowid, name, value) for name, value in flatten(result).items()])
+
+    def history(self, name: str, sample: str) -> list[float]:
+        """Return the past values of a sample of a test case on this host and kernel release."""
+        return [row[0] for row in self._db.execute(
+            'SELECT samples.value FROM results JOIN samples ON samples.result = results.id '
+            'WHERE results.host = ? AND results.release = ? AND results.name = ? AND results.passed AND '
+            'samples.name = ?', (self._host, self._release, name, sample))]
+
+    def compare(self, results: list[meta.TestResult]) -> list[str]:
+        """Return what looks significantly worse than the history, before adding the results to it.
+
+        Phases and costs regress by growing, while any significant change of a metric is suspicious. The median and
+        the median absolute deviation keep a few outliers in the history from hiding a regression.
+        """
+        min_runs = meta.param('history.min_runs', 5)
+        sigma = meta.param('history.sigma', 3.0)
+        min_change = meta.param('history.min_change', 0.1)
+        # Scheduling noise alone easily doubles a phase of a few milliseconds.
+        min_seconds = meta.param('history.min_seconds', 0.05)
+        regressions = []
+        for result in results:
+            if not result.passed:
+                continue
+
+            for sample, value in flatten(result).items():
+                past = self.history(result.name, sample)
+                if len(past) < min_runs:
+                    continue
+
+                median = statistics.median(past)
+                mad = statistics.median(abs(old - median) for old in past)
+                change = value - median if sample.startswith(('phase.', 'cost.')) else abs(value - median)
+                if sample.startswith('phase.') and change < min_seconds:
+                    continue
+                if change > sigma * 1.4826 * mad and change > min_change * abs(median):
+                    regressions.append(f'test case "{result.name}" has {sample} {value:g} against the median '
+                                       f'{median:g} of {len(past)} runs')
+
+        return regressions
+
+    def close(self) -> None:
+        self._db.close()
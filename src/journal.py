@@ -0,0 +1,96 @@
+# Copyright (c) 2022, Qualcomm Innovation Center, Inc. All rights reserved.
+# SPDX-License-Identifier: GPL-2.0-or-later
+
+from __future__ import annotations
+
+import json
+import os
+import time
+import typing
+
+from src import meta
+
+
+class Journal:
+    """A write-ahead journal of a run with every record synced to disk, so the run can resume after a panic or hang.
+
+    Each phase is recorded before it starts, so the last phase without a finished test case is what took the machine
+    down. Forked workers inherit the file descriptor, and every record is written at once with O_APPEND.
+    """
+
+    def __init__(self, path: str) -> None:
+        self._path: str = path
+        self._fd: int = -1
+
+    @property
+    def quarantine_path(self) -> str:
+        return self._path + '.quarantine'
+
+    @property
+    def quarantined(self) -> set[str]:
+        """Test cases which brought down the machine before, and won't run with this journal again."""
+        if not os.path.exists(self.quarantine_path):
+            return set()
+
+        with open(self.quarantine_path) as f:
+            return {line.rstrip('\n') for line in f if line.strip()}
+
+    def recover(self) -> tuple[set[str], dict[str, str]]:
+        """Return the test cases finished or skipped in the last run, and the phases of those in flight at its end."""
+        done = set()
+        in_flight = {}
+        if not os.path.exists(self._path):
+            return done, in_flight
+
+        with open(self._path) as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # The last record could be torn if we died in the middle of writing it.
+                    continue
+
+                if record['event'] == 'begin':
+                    done.clear()
+                    in_flight.clear()
+                elif record['event'] == 'phase':
+                    in_flight[record['case']] = record['phase']
+                elif record['event'] in ('finish', 'skip'):
+                    done.add(record['case'])
+                    in_flight.pop(record['case'], None)
+                elif record['event'] == 'end':
+                    in_flight.clear()
+
+        return done, in_flight
+
+    def write(self, event: str, **fields: typing.Any) -> None:
+        line = json.dumps({'event': event, 'time': time.time(), 'pid': os.getpid(), **fields})
+        os.write(self._fd, line.encode() + b'\n')
+        os.fsync(self._fd)
+
+    def start(self, names: list[str], resume: bool) -> None:
+        flags = os.O_RDWR | os.O_CREAT | os.O_APPEND | (0 if resume else os.O_TRUNC)
+        self._fd = os.open(self._path, flags, 0o644)
+        # Don't glue the first record to a torn one.
+        size = os.fstat(self._fd).st_size
+        if size and os.pread(self._fd, 1, size - 1) != b'\n':
+            os.write(self._fd, b'\n')
+        self.write('resume' if resume else 'begin', cases=names)
+
+    def phase(self, test_case: meta.TestCase, phase: str) -> None:
+        self.write('phase', case=test_case.name, phase=phase)
+
+    def finish(self, result: meta.TestResult) -> None:
+        self.write('finish', case=result.name, passed=result.passed)
+
+    def skip(self, name: str, quarantine: bool) -> None:
+        self.write('skip', case=name, quarantine=quarantine)
+        if quarantine:
+            with open(self.quarantine_path, 'a') as f:
+                f.write(name + '\n')
+                f.flush()
+                os.fsync(f.fileno())
+
+    def close(self) -> None:
+        self.write('end')
+        os.close(self._fd)
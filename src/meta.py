@@ -3,12 +3,40 @@
 
 from __future__ import annotations
 
+import contextlib
 import dataclasses
+import heapq
+import itertools
 import os
+import select
 import signal
+import sys
 import threading
+import time
+import traceback
 import typing
 
+from src import trace
+
+
+# Set by "-d" to measure the cost of each phase, e.g., "perf.Profiler". Forked workers inherit it.
+profiler: typing.Optional[typing.Any] = None
+# Set by "--format" to write machine-readable events, e.g., "report.Reporter". Forked workers inherit it.
+reporter: typing.Optional[typing.Any] = None
+# Set by "--journal" to record each phase on disk before it starts, e.g., "journal.Journal".
+journal: typing.Optional[typing.Any] = None
+
+# Tunables given on the command line, e.g., "pcie.slow_ms=100". Forked workers inherit them.
+params: dict[str, str] = {}
+
+
+def param(name: str, default: typing.Any) -> typing.Any:
+    """Return a tunable converted to the type of its default value."""
+    if name not in params:
+        return default
+
+    return type(default)(params[name])
+
 
 @dataclasses.dataclass(frozen=True)
 class TestCase:
@@ -17,6 +45,36 @@ class TestCase:
     run: typing.Callable[[Watchdog], None]
     setup: typing.Callable[[Watchdog], None] = lambda x: None
     cleanup: typing.Callable[[Watchdog], None] = lambda x: None
+    # Resources held exclusively while running, so the scheduler won't run conflicting test cases at the same time.
+    resources: frozenset[str] = frozenset()
+    # What it exercises like "cpu", "memory" or "io", or "slow", so test cases can be selected by them.
+    tags: frozenset[str] = frozenset()
+    # Optional deadlines nested within the above timeout for each phase.
+    setup_timeout: float = 0
+    run_timeout: float = 0
+    cleanup_timeout: float = 0
+
+
+# Test cases registered by their numbers, which are filled in as their modules are imported.
+cases: dict[int, TestCase] = {}
+Phase = typing.Callable[['Watchdog'], None]
+
+
+def case(number: int, name: str, timeout: int, tags: tuple[str, ...] = (), resources: tuple[str, ...] = (),
+         **kwargs: typing.Any) -> typing.Callable[[Phase], Phase]:
+    """Register the decorated function as the run phase of a test case, e.g., with "setup" and "cleanup" as well.
+
+    "data.Mapping" finds the number, name and tags without importing the module, so they need to be literals.
+    """
+    def decorator(run: Phase) -> Phase:
+        if number in cases:
+            raise RuntimeError(f'The test case {number} is registered twice.')
+
+        cases[number] = TestCase(name=name, timeout=timeout, run=run, resources=frozenset(resources),
+                                 tags=frozenset(tags), **kwargs)
+        return run
+
+    return decorator
 
 
 @dataclasses.dataclass(frozen=True)
@@ -24,46 +82,308 @@ class TestRun:
     timeout: int
 
 
+@dataclasses.dataclass
+class TestResult:
+    name: str
+    # Seconds spent in each phase, e.g., "setup", "run" and "cleanup".
+    phases: dict[str, float] = dataclasses.field(default_factory=dict)
+    error: typing.Optional[str] = None
+    stdout: str = ''
+    stderr: str = ''
+    children: list[ChildUsage] = dataclasses.field(default_factory=list)
+    # Whatever the test case measures, e.g., file counts or frequencies.
+    metrics: dict[str, typing.Any] = dataclasses.field(default_factory=dict)
+    # What each phase costs, e.g., page faults and context switches from "-d".
+    costs: dict[str, dict[str, float]] = dataclasses.field(default_factory=dict)
+    # Trace spans from "-d" of the process running it and its children, which the main process merges.
+    spans: list[trace.Span] = dataclasses.field(default_factory=list)
+
+    @property
+    def passed(self) -> bool:
+        return self.error is None
+
+
+@dataclasses.dataclass(frozen=True)
+class ChildUsage:
+    pid: int
+    exitcode: int
+    # Whether the test case asked for it to end.
+    expected: bool
+    utime: float
+    stime: float
+    # In KiB.
+    maxrss: int
+    nvcsw: int
+    nivcsw: int
+
+    def __str__(self) -> str:
+        return (f'pid {self.pid}, exit code {self.exitcode}, CPU time {self.utime + self.stime:.3f}s, '
+                f'max RSS {self.maxrss} KiB, context switches {self.nvcsw} voluntary {self.nivcsw} involuntary')
+
+
+class Supervisor:
+    """Reap children as soon as they exit with pidfds and epoll, and account for their resource usage."""
+
+    def __init__(self) -> None:
+        self._epoll: select.epoll = select.epoll()
+        # pidfd -> pid
+        self._pidfds: dict[int, int] = {}
+        self._expected: set[int] = set()
+        self._usage: list[ChildUsage] = []
+        self._cond: threading.Condition = threading.Condition()
+        self._thread: typing.Optional[threading.Thread] = None
+
+    def watch(self, pid: int) -> None:
+        fd = os.pidfd_open(pid)
+        with self._cond:
+            self._pidfds[fd] = pid
+        # It is fine to do this while the loop is waiting.
+        self._epoll.register(fd, select.EPOLLIN)
+
+        if not self._thread:
+            self._thread = threading.Thread(target=self.loop, daemon=True)
+            self._thread.start()
+
+    def expect(self, pid: int) -> None:
+        """The child is about to be told to exit, so don't treat it as a failure."""
+        with self._cond:
+            self._expected.add(pid)
+
+    def loop(self) -> None:
+        while True:
+            for fd, _ in self._epoll.poll():
+                self.reap(fd)
+
+    def reap(self, fd: int) -> None:
+        self._epoll.unregister(fd)
+        os.close(fd)
+        with self._cond:
+            pid = self._pidfds.pop(fd)
+            try:
+                _, status, rusage = os.wait4(pid, 0)
+            except ChildProcessError:
+                # Somebody else, e.g., the watchdog, has reaped it.
+                pass
+            else:
+                self._usage.append(ChildUsage(pid=pid, exitcode=os.waitstatus_to_exitcode(status),
+                                              expected=pid in self._expected, utime=rusage.ru_utime,
+                                              stime=rusage.ru_stime, maxrss=rusage.ru_maxrss,
+                                              nvcsw=rusage.ru_nvcsw, nivcsw=rusage.ru_nivcsw))
+            self._expected.discard(pid)
+            self._cond.notify_all()
+
+    def collect(self, timeout: float = 5) -> list[ChildUsage]:
+        """Wait for the watched children to go away, and hand over everything reaped so far."""
+        with self._cond:
+            self._cond.wait_for(lambda: not self._pidfds, timeout=timeout)
+            usage = self._usage
+            self._usage = []
+
+        return usage
+
+
 class Watchdog:
+    """Kill everything registered once any deadline passes, using a single monitor thread with a deadline heap."""
+
+    # Seconds between SIGTERM and SIGKILL.
+    grace: float = 5
+
     def __init__(self) -> None:
         # We will need to kill children first, so we will use a stack.
         self._pids: list[int] = [os.getpid()]
-        self._timers: dict[typing.Union[TestRun, TestCase], threading.Timer] = {}
+        # (deadline, sequence) so a cancelled and re-armed key can be told apart from its stale heap entries.
+        self._heap: list[tuple[float, int, typing.Hashable]] = []
+        self._armed: dict[typing.Hashable, int] = {}
+        self._seq: itertools.count = itertools.count()
+        self._cond: threading.Condition = threading.Condition()
+        self._thread: typing.Optional[threading.Thread] = None
         # We can use it to pass values within a test case.
         self._storage: dict[typing.Any, typing.Any] = {}
+        self._supervisor: Supervisor = Supervisor()
+        self._metrics: dict[str, typing.Any] = {}
 
     @property
     def storage(self) -> dict[typing.Any, typing.Any]:
         return self._storage
 
+    @property
+    def metrics(self) -> dict[str, typing.Any]:
+        """Test cases save their measurements here to end up in the result."""
+        return self._metrics
+
+    @property
+    def supervisor(self) -> Supervisor:
+        return self._supervisor
+
     def kill(self) -> None:
-        while self._pids:
-            os.kill(self._pids.pop(), signal.SIGTERM)
+        me = os.getpid()
+        # Kill the whole process group for any group leader, so its descendants won't be left behind.
+        victims = {pid: is_group_leader(pid) for pid in reversed(self._pids) if pid != me}
+        self._pids.clear()
+        for pid, group in victims.items():
+            signal_pid(pid, signal.SIGTERM, group)
 
-    def register(self, target: typing.Union[TestRun, TestCase]) -> None:
-        if target.timeout == 0:
+        end = time.monotonic() + self.grace
+        while victims and time.monotonic() < end:
+            time.sleep(0.05)
+            victims = {pid: group for pid, group in victims.items() if signal_pid(pid, 0, group)}
+
+        for pid, group in victims.items():
+            print(f'- Error: escalate to SIGKILL for {pid}.', file=sys.stderr)
+            signal_pid(pid, signal.SIGKILL, group)
+
+        os.kill(me, signal.SIGTERM)
+        # We should not get here unless SIGTERM is handled or ignored.
+        time.sleep(self.grace)
+        os.kill(me, signal.SIGKILL)
+
+    def monitor(self) -> None:
+        with self._cond:
+            while True:
+                # Drop cancelled entries lazily.
+                while self._heap and self._armed.get(self._heap[0][2]) != self._heap[0][1]:
+                    heapq.heappop(self._heap)
+
+                if not self._heap:
+                    self._cond.wait()
+                elif (remain := self._heap[0][0] - time.monotonic()) > 0:
+                    self._cond.wait(timeout=remain)
+                else:
+                    break
+
+        self.kill()
+
+    def arm(self, key: typing.Hashable, timeout: float) -> None:
+        if timeout == 0:
             return
 
-        assert target not in self._timers
+        with self._cond:
+            assert key not in self._armed
+
+            seq = next(self._seq)
+            self._armed[key] = seq
+            heapq.heappush(self._heap, (time.monotonic() + timeout, seq, key))
+            if not self._thread:
+                # We want the thread to end if the main thread is terminated.
+                self._thread = threading.Thread(target=self.monitor, daemon=True)
+                self._thread.start()
+            self._cond.notify()
 
-        timer = threading.Timer(interval=target.timeout, function=self.kill)
-        # We want the timer to end if the main thread is terminated.
-        timer.daemon = True
-        timer.start()
-        self._timers[target] = timer
+    def disarm(self, key: typing.Hashable) -> None:
+        with self._cond:
+            # This won't report any errors, and the heap entry is going to be dropped by the monitor.
+            self._armed.pop(key, None)
+
+    @contextlib.contextmanager
+    def deadline(self, key: typing.Hashable, timeout: float) -> typing.Iterator[None]:
+        """Nest a deadline within the registered ones, e.g., for a single phase of a test case."""
+        self.arm(key, timeout)
+        try:
+            yield
+        finally:
+            self.disarm(key)
+
+    def register(self, target: typing.Union[TestRun, TestCase]) -> None:
+        self.arm(target, target.timeout)
 
     def unregister(self, target: typing.Union[TestRun, TestCase]) -> None:
         if target.timeout == 0:
             return
 
-        assert target in self._timers
-
-        # This won't report any errors.
-        self._timers[target].cancel()
-        del self._timers[target]
+        assert target in self._armed
+        self.disarm(target)
 
     def add_pid(self, pid: int) -> None:
         self._pids.append(pid)
 
     def del_pid(self, pid: int) -> None:
         self._pids.remove(pid)
+
+    def add_child(self, pid: int) -> None:
+        """Track a child that will be reaped by the supervisor, so don't wait for it elsewhere."""
+        self.add_pid(pid)
+        self._supervisor.watch(pid)
+
+    def del_child(self, pid: int) -> None:
+        self._supervisor.expect(pid)
+        self.del_pid(pid)
+
+
+def signal_pid(pid: int, sig: int, group: bool) -> bool:
+    """Signal a process or its whole process group, and return whether anything is still there."""
+    try:
+        # Reap our own children, or they will look alive forever as zombies.
+        os.waitpid(pid, os.WNOHANG)
+    except ChildProcessError:
+        pass
+
+    try:
+        if group:
+            os.killpg(pid, sig)
+        else:
+            os.kill(pid, sig)
+    except ProcessLookupError:
+        return False
+
+    return True
+
+
+def is_group_leader(pid: int) -> bool:
+    try:
+        return os.getpgid(pid) == pid
+    except ProcessLookupError:
+        return False
+
+
+def execute(test_case: TestCase, watchdog: Watchdog) -> TestResult:
+    """Run all phases of a test case, and stop at the first failing one."""
+    result = TestResult(name=test_case.name)
+    watchdog.metrics.clear()
+    watchdog.register(test_case)
+    if reporter:
+        reporter.start(test_case)
+    try:
+        for phase in ('setup', 'run', 'cleanup'):
+            if journal:
+                journal.phase(test_case, phase)
+            start = time.monotonic()
+            if profiler:
+                profiler.start()
+            try:
+                with watchdog.deadline((test_case, phase), getattr(test_case, f'{phase}_timeout')), \
+                        trace.span(f'{test_case.name} {phase}'):
+                    getattr(test_case, phase)(watchdog)
+            finally:
+                result.phases[phase] = time.monotonic() - start
+                if profiler:
+                    result.costs[phase] = profiler.stop()
+                    print(f'- Cost of {phase}: {profiler.format(result.costs[phase])}.')
+                if reporter:
+                    reporter.phase(test_case, phase, result.phases[phase], sys.exc_info()[1])
+    except Exception as e:
+        traceback.print_exc()
+        result.error = f'{phase}: {e}'
+    finally:
+        watchdog.unregister(test_case)
+
+    result.metrics = dict(watchdog.metrics)
+    result.children = watchdog.supervisor.collect()
+    result.spans = trace.export()
+    for usage in result.children:
+        print(f'- Child {usage}.')
+        if not usage.expected and result.passed:
+            result.error = f'child {usage.pid} exited unexpectedly with {usage.exitcode}'
+
+    return result
+
+
+def report(result: TestResult) -> None:
+    """Print how a test case ended, and pass it on to the machine-readable output if any."""
+    if not result.passed:
+        print(f'- Error: test case "{result.name}" failed in {result.error}', file=sys.stderr)
+    print(f'- Finish test case: {result.name} ({sum(result.phases.values()):.3f}s)')
+    trace.merge(result.spans)
+    if reporter:
+        reporter.finish(result)
+    if journal:
+        journal.finish(result)
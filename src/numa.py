@@ -4,14 +4,21 @@
 # "check.py" will get us into a circular import.
 from __future__ import annotations
 
+import array
 import ctypes
-import ctypes.util
 import mmap
 import os
 import resource
+import sys
+import threading
+import time
 import typing
 
+from src import counters
 from src import meta
+from src import stats
+from src import syscalls
+from src import trace
 from src import utils
 
 
@@ -19,18 +26,12 @@ class Numa:
     def __init__(self, nr_node: int) -> None:
         self._nr_node: int = nr_node
         self._sysfs: str = f'/sys/devices/system/node/node{nr_node}'
-        # All system call numbers are from "include/uapi/asm-generic/unistd.h".
-        self._nr_mbind: int = 235
-        self._nr_get_mempolicy: int = 236
-        self._nr_set_mempolicy: int = 237
-        self._nr_migrate_pages: int = 238
-        self._nr_move_pages: int = 239
         # from "include/uapi/linux/mempolicy.h"
         self._policy: utils.DoubleDict = utils.DoubleDict(['MPOL_DEFAULT', 'MPOL_PREFERRED', 'MPOL_BIND',
                                                            'MPOL_INTERLEAVE', 'MPOL_LOCAL', 'MPOL_PREFERRED_MANY'])
-        self._syscall: typing.Callable[[ctypes.c_long, ...], typing.Any] = ctypes.CDLL(
-            name=ctypes.util.find_library('c'), use_errno=True).syscall
         self._maxnode: int = 4096
+        # from "include/uapi/linux/mempolicy.h"
+        self._mf_move: int = 1 << 1
 
     @property
     def nr_node(self) -> int:
@@ -42,51 +43,61 @@ class Numa:
 
     @property
     def nr_mbind(self) -> int:
-        return self._nr_mbind
+        return syscalls.MBIND.nr
 
     @property
     def nr_get_mempolicy(self) -> int:
-        return self._nr_get_mempolicy
+        return syscalls.GET_MEMPOLICY.nr
 
     @property
     def nr_set_mempolicy(self) -> int:
-        return self._nr_set_mempolicy
+        return syscalls.SET_MEMPOLICY.nr
 
     @property
     def nr_migrate_pages(self) -> int:
-        return self._nr_migrate_pages
+        return syscalls.MIGRATE_PAGES.nr
 
     @property
     def nr_move_pages(self) -> int:
-        return self._nr_move_pages
+        return syscalls.MOVE_PAGES.nr
 
     @property
     def policy(self) -> utils.DoubleDict:
         return self._policy
 
-    @property
-    def syscall(self) -> typing.Callable[..., typing.Any]:
-        return self._syscall
-
     @property
     def maxnode(self) -> int:
         return self._maxnode
 
+    @property
+    def mf_move(self) -> int:
+        return self._mf_move
+
     def get_mempolicy(self, mode: 'ctypes.byref', nodemask: ctypes.Array, maxnode: int, addr: typing.Optional[int],
                       flags: int) -> None:
-        self.syscall.argtypes = [ctypes.c_long, ctypes.POINTER(ctypes.c_int), ctypes.POINTER(ctypes.c_ulong),
-                                 ctypes.c_ulong, ctypes.c_void_p, ctypes.c_int]
-        self.syscall.restype = ctypes.c_long
+        syscalls.GET_MEMPOLICY(mode, nodemask, maxnode, addr, flags)
 
-        if self.syscall(self.nr_get_mempolicy, mode, nodemask, maxnode, addr, flags):
-            raise OSError(f'error from get_mempolicy():', os.strerror(ctypes.get_errno()))
+    def mbind(self, addr: int, length: int, mode: int, nodemask: ctypes.Array, maxnode: int, flags: int) -> None:
+        syscalls.MBIND(addr, length, mode, nodemask, maxnode, flags)
 
-    def set_mempolicy(self, mode: int, nodemask: ctypes.Array, maxnode: int) -> None:
-        self.syscall.argtypes = [ctypes.c_long, ctypes.c_int, ctypes.POINTER(ctypes.c_ulong), ctypes.c_ulong]
-        self.syscall.restype = ctypes.c_long
+    def move_pages(self, pid: int, count: int, pages: ctypes.Array, nodes: typing.Optional[ctypes.Array],
+                   status: ctypes.Array, flags: int) -> int:
+        """Return the number of pages not moved, and each page's node or a negative errno is in "status"."""
+        return syscalls.MOVE_PAGES(pid, count, pages, nodes, status, flags)
+
+    def migrate_pages(self, pid: int, maxnode: int, old_nodes: ctypes.Array, new_nodes: ctypes.Array) -> int:
+        """Move all pages of a process, and return the number of pages not moved."""
+        return syscalls.MIGRATE_PAGES(pid, maxnode, old_nodes, new_nodes)
+
+    def nodemask(self, nodes: list[int]) -> ctypes.Array:
+        nodemask = (ctypes.c_ulong * (self.maxnode // 64))()
+        for node in nodes:
+            nodemask[node // 64] |= 1 << (node % 64)
+
+        return nodemask
 
-        if self.syscall(self.nr_set_mempolicy, mode, nodemask, maxnode):
-            raise OSError(f'error from set_mempolicy():', os.strerror(ctypes.get_errno()))
+    def set_mempolicy(self, mode: int, nodemask: ctypes.Array, maxnode: int) -> None:
+        syscalls.SET_MEMPOLICY(mode, nodemask, maxnode)
 
 
 def check_numa_node(watchdog: meta.Watchdog) -> None:
@@ -103,33 +114,288 @@ def check_numa_node(watchdog: meta.Watchdog) -> None:
     print(f'- Current NUMA policy is {numa.policy[mode.value]}.')
 
 
+def restore_numa_policy(watchdog: meta.Watchdog) -> None:
+    mode = watchdog.storage['mode']
+    nodemask = watchdog.storage['nodemask']
+    numa = watchdog.storage['numa']
+
+    print(f'- Restore NUMA policy to {numa.policy[mode.value]}.')
+    numa.set_mempolicy(mode=mode, nodemask=nodemask, maxnode=numa.maxnode)
+
+
+@meta.case(3, name='Allocate memory in a NUMA node.', timeout=30, tags=('memory',), resources=('mempolicy',),
+           setup=check_numa_node, cleanup=restore_numa_policy)
 def allocate_numa_node(watchdog: meta.Watchdog) -> None:
     numa = watchdog.storage['numa']
     nodemask = (ctypes.c_ulong * numa.maxnode)()
     nodemask[0] = ctypes.c_ulong(1 << numa.nr_node)
     numa.set_mempolicy(mode=numa.policy['MPOL_BIND'], nodemask=nodemask, maxnode=numa.maxnode)
 
-    numastat = os.path.join(numa.sysfs, 'numastat')
-    old_numa_hit = utils.parse_pair_file(file=numastat)['numa_hit']
+    numastat = counters.Counters()
+    numastat.add('numastat', os.path.join(numa.sysfs, 'numastat'), keys=['numa_hit'])
+    old = numastat.snapshot()
 
     num_pages = 1024
     print(f'- Allocate {num_pages} on NUMA node {numa.nr_node}.')
-    for _ in range(num_pages):
-        with mmap.mmap(-1, resource.getpagesize()) as mm:
-            mm.write(b'0')
+    with trace.span('numa.allocate'):
+        for _ in range(num_pages):
+            with mmap.mmap(-1, resource.getpagesize()) as mm:
+                mm.write(b'0')
 
-    new_numa_hit = utils.parse_pair_file(file=numastat)['numa_hit']
-    delta = int(new_numa_hit) - int(old_numa_hit)
+    new = numastat.snapshot()
+    numastat.close()
+    delta = numastat.delta(old, new)['numastat.numa_hit']
     print(f'- The delta from "numa_hit" is {delta}.')
     # We probably won't get the exact delta due to debugging features like KASAN.
     if delta < num_pages:
-        raise OSError(f'unexpected "numa_hit": old {old_numa_hit}; new {new_numa_hit}')
+        raise OSError(f'unexpected "numa_hit": old {old.values[0]}; new {new.values[0]}')
 
 
-def restore_numa_policy(watchdog: meta.Watchdog) -> None:
-    mode = watchdog.storage['mode']
-    nodemask = watchdog.storage['nodemask']
-    numa = watchdog.storage['numa']
+class NodeBuffer:
+    """A large anonymous mapping with all its pages bound to a NUMA node."""
 
-    print(f'- Restore NUMA policy to {numa.policy[mode.value]}.')
-    numa.set_mempolicy(mode=mode, nodemask=nodemask, maxnode=numa.maxnode)
+    def __init__(self, numa: Numa, nr_node: int, size: int) -> None:
+        self._nr_node: int = nr_node
+        self._size: int = size
+        self._mm: mmap.mmap = mmap.mmap(-1, size)
+        self._buffer: ctypes.Array = (ctypes.c_char * size).from_buffer(self._mm)
+        self._addr: int = ctypes.addressof(self._buffer)
+        numa.mbind(addr=self._addr, length=size, mode=numa.policy['MPOL_BIND'], nodemask=numa.nodemask([nr_node]),
+                   maxnode=numa.maxnode, flags=0)
+        # Fault everything in now, so we only measure the memory itself later.
+        ctypes.memset(self._addr, 1, size)
+
+    @property
+    def nr_node(self) -> int:
+        return self._nr_node
+
+    @property
+    def addr(self) -> int:
+        return self._addr
+
+    @property
+    def size(self) -> int:
+        return self._size
+
+    def close(self) -> None:
+        del self._buffer
+        self._mm.close()
+
+
+def measure_bandwidth(buffer: NodeBuffer, cpus: list[int], nr_threads: int, chunk: int) -> tuple[float, float, float]:
+    """Fill and copy the buffer from threads pinned to the CPUs, and return fill and copy GB/s plus p50 chunk us."""
+    # ctypes drops the GIL while calling memset() and memmove(), so the threads do run in parallel.
+    half = buffer.size // 2
+    share = half // nr_threads // chunk * chunk
+    latencies = [[] for _ in range(nr_threads)]
+    elapsed = {'fill': [0.0] * nr_threads, 'copy': [0.0] * nr_threads}
+    barrier = threading.Barrier(nr_threads)
+
+    def kernel(index: int) -> None:
+        os.sched_setaffinity(0, cpus)
+        src = buffer.addr + index * share
+        barrier.wait()
+        start = time.perf_counter()
+        with trace.span('numa.fill'):
+            ctypes.memset(src, index, share)
+        elapsed['fill'][index] = time.perf_counter() - start
+
+        barrier.wait()
+        start = time.perf_counter()
+        with trace.span('numa.copy'):
+            for offset in range(0, share, chunk):
+                begin = time.perf_counter_ns()
+                ctypes.memmove(src + half + offset, src + offset, chunk)
+                latencies[index].append(time.perf_counter_ns() - begin)
+        elapsed['copy'][index] = time.perf_counter() - start
+
+    threads = [threading.Thread(target=kernel, args=(index,)) for index in range(nr_threads)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    total = share * nr_threads
+    return (total / max(elapsed['fill']) / 1e9, total / max(elapsed['copy']) / 1e9,
+            stats.percentile([ns for items in latencies for ns in items], 50) / 1000)
+
+
+@meta.case(10, name='Measure NUMA memory bandwidth.', timeout=120, tags=('memory', 'slow'),
+           resources=('cpus', 'memory'))
+def bench_numa_nodes(watchdog: meta.Watchdog) -> None:
+    """Measure the bandwidth from every CPU node to every memory node, and check local beats remote."""
+    mem_nodes = utils.nodes_with('has_memory')
+    cpu_nodes = utils.nodes_with('has_cpu')
+    size = meta.param('numa.bench.mb', 256) << 20
+    nr_threads = meta.param('numa.bench.threads', 4)
+    chunk = meta.param('numa.bench.chunk_kb', 64) << 10
+    ratio = meta.param('numa.bench.ratio', 0.9)
+    numa = Numa(nr_node=mem_nodes[0])
+
+    buffers = [NodeBuffer(numa=numa, nr_node=node, size=size) for node in mem_nodes]
+    matrix = {}
+    try:
+        for cpu_node in cpu_nodes:
+            cpus = utils.node_cpus(cpu_node)
+            for buffer in buffers:
+                fill, copy, latency = measure_bandwidth(buffer=buffer, cpus=cpus, chunk=chunk,
+                                                        nr_threads=min(nr_threads, len(cpus)))
+                matrix[(cpu_node, buffer.nr_node)] = (fill, copy, latency)
+    finally:
+        for buffer in buffers:
+            buffer.close()
+
+    print('- CPU node -> memory node: fill GB/s, copy GB/s, p50 latency per chunk in us')
+    for (cpu_node, mem_node), (fill, copy, latency) in matrix.items():
+        print(f'  {cpu_node} -> {mem_node}: {fill:.2f}, {copy:.2f}, {latency:.1f}')
+    watchdog.metrics['matrix'] = {f'{cpu_node}-{mem_node}': values for (cpu_node, mem_node), values in matrix.items()}
+
+    slow = []
+    for (cpu_node, mem_node), (_, copy, _) in matrix.items():
+        local = matrix.get((cpu_node, cpu_node))
+        if local and mem_node != cpu_node and local[1] < copy * ratio:
+            print(f'- Error: node {cpu_node} copies local memory at {local[1]:.2f} GB/s, slower than '
+                  f'{copy:.2f} GB/s from node {mem_node}.', file=sys.stderr)
+            slow.append((cpu_node, mem_node))
+
+    if slow:
+        raise OSError(f'Local memory is slower than remote for {slow}.')
+
+
+def check_migrate_nodes(watchdog: meta.Watchdog) -> None:
+    if len(utils.nodes_with('has_memory')) < 2:
+        raise OSError('Page migration needs at least two NUMA nodes with memory.')
+
+
+def move_region(numa: Numa, pages: ctypes.Array, node: int, batch: int) -> tuple[float, ctypes.Array]:
+    """Move all pages to a node in batches, and return the seconds spent plus the final status of each page."""
+    count = len(pages)
+    nodes = (ctypes.c_int * count)(*([node] * count))
+    status = (ctypes.c_int * count)()
+    elapsed = 0.0
+    for start in range(0, count, batch):
+        size = min(batch, count - start)
+        # Point into the arrays instead of copying them.
+        batch_pages = (ctypes.c_void_p * size).from_buffer(pages, start * ctypes.sizeof(ctypes.c_void_p))
+        batch_nodes = (ctypes.c_int * size).from_buffer(nodes, start * ctypes.sizeof(ctypes.c_int))
+        batch_status = (ctypes.c_int * size).from_buffer(status, start * ctypes.sizeof(ctypes.c_int))
+        begin = time.perf_counter()
+        with trace.span('numa.move_pages'):
+            numa.move_pages(pid=0, count=size, pages=batch_pages, nodes=batch_nodes, status=batch_status,
+                            flags=numa.mf_move)
+        elapsed += time.perf_counter() - begin
+
+    return elapsed, status
+
+
+@meta.case(11, name='Migrate pages between NUMA nodes.', timeout=120, tags=('memory', 'slow'),
+           resources=('memory',), setup=check_migrate_nodes)
+def migrate_numa_pages(watchdog: meta.Watchdog) -> None:
+    """Move a large region between every pair of nodes in batches of various sizes, and check where it ends up."""
+    mem_nodes = utils.nodes_with('has_memory')
+    numa = Numa(nr_node=mem_nodes[0])
+    page_size = resource.getpagesize()
+    size = meta.param('numa.migrate.mb', 64) << 20
+    batches = [int(item) for item in meta.param('numa.migrate.batches', '64,512,4096').split(',')]
+
+    with mmap.mmap(-1, size) as mm:
+        buffer = (ctypes.c_char * size).from_buffer(mm)
+        addr = ctypes.addressof(buffer)
+        ctypes.memset(addr, 1, size)
+        pages = (ctypes.c_void_p * (size // page_size))(*range(addr, addr + size, page_size))
+        misplaced = []
+        try:
+            for src in mem_nodes:
+                for dst in mem_nodes:
+                    if src == dst:
+                        continue
+
+                    for batch in batches:
+                        # Start from the source node every time, and don't count it.
+                        move_region(numa=numa, pages=pages, node=src, batch=len(pages))
+                        elapsed, status = move_region(numa=numa, pages=pages, node=dst, batch=batch)
+                        wrong = sum(1 for node in status if node != dst)
+                        print(f'- {src} -> {dst} in batches of {batch}: {len(pages) / elapsed:.0f} pages/s, '
+                              f'{elapsed / len(pages) * 1e6:.2f} us per page, {wrong} pages misplaced.')
+                        watchdog.metrics[f'{src}-{dst}-{batch}'] = len(pages) / elapsed
+                        if wrong:
+                            errors = {-node for node in status if node < 0}
+                            print(f'- Error: {[os.strerror(err) for err in errors]}', file=sys.stderr)
+                            misplaced.append((src, dst, batch))
+        finally:
+            del buffer
+
+    if misplaced:
+        raise OSError(f'Pages are not all moved for {misplaced}.')
+
+
+def page_nodes(numa: Numa, addr: int, size: int) -> array.array:
+    """Return the node of every page in a region, or a negative errno for those not faulted in, in one syscall."""
+    page_size = resource.getpagesize()
+    count = size // page_size
+    pages = (ctypes.c_void_p * count)(*range(addr, addr + count * page_size, page_size))
+    status = (ctypes.c_int * count)()
+    # Without target nodes, it only reports where the pages are.
+    numa.move_pages(pid=0, count=count, pages=pages, nodes=None, status=status, flags=0)
+    nodes = array.array('i')
+    nodes.frombytes(memoryview(status).cast('B'))
+
+    return nodes
+
+
+def placement(nodes: array.array, nr_nodes: int) -> array.array:
+    """Return a histogram of pages per node, with anything not placed in the last slot."""
+    histogram = array.array('Q', [nodes.count(node) for node in range(nr_nodes)])
+    histogram.append(len(nodes) - sum(histogram))
+
+    return histogram
+
+
+@meta.case(12, name='Verify NUMA policy placement.', timeout=120, tags=('memory',), resources=('memory',))
+def verify_numa_policy(watchdog: meta.Watchdog) -> None:
+    """Fault a large region under each memory policy, and check where every single page ends up."""
+    mem_nodes = utils.nodes_with('has_memory')
+    numa = Numa(nr_node=mem_nodes[-1])
+    size = meta.param('numa.place.mb', 1024) << 20
+    nr_nodes = max(mem_nodes) + 1
+    # (policy, nodes) and whether a histogram is fine.
+    checks = [
+        ('MPOL_BIND', [numa.nr_node], lambda histogram, total: histogram[numa.nr_node] == total),
+        # Interleaving goes by the page offset, so it should be as balanced as it can be.
+        ('MPOL_INTERLEAVE', mem_nodes,
+         lambda histogram, total: max(histogram[node] for node in mem_nodes) -
+         min(histogram[node] for node in mem_nodes) <= 1 and sum(histogram[:-1]) == total),
+        ('MPOL_PREFERRED_MANY', mem_nodes[-2:],
+         lambda histogram, total: sum(histogram[node] for node in mem_nodes[-2:]) == total),
+    ]
+
+    failed = []
+    for policy, nodes, check in checks:
+        with mmap.mmap(-1, size) as mm:
+            buffer = (ctypes.c_char * size).from_buffer(mm)
+            addr = ctypes.addressof(buffer)
+            try:
+                numa.mbind(addr=addr, length=size, mode=numa.policy[policy], nodemask=numa.nodemask(nodes),
+                           maxnode=numa.maxnode, flags=0)
+            except OSError as e:
+                # MPOL_PREFERRED_MANY is only there since 5.15.
+                print(f'- Skip {policy}: {e}')
+                del buffer
+                continue
+
+            ctypes.memset(addr, 1, size)
+            start = time.perf_counter()
+            histogram = placement(page_nodes(numa=numa, addr=addr, size=size), nr_nodes)
+            elapsed = time.perf_counter() - start
+            del buffer
+
+        total = size // resource.getpagesize()
+        print(f'- {policy} on nodes {nodes}: {list(histogram[:-1])} pages per node, {histogram[-1]} elsewhere '
+              f'({elapsed:.3f}s to verify).')
+        watchdog.metrics[policy] = list(histogram)
+        if not check(histogram, total):
+            print(f'- Error: unexpected placement for {policy}.', file=sys.stderr)
+            failed.append(policy)
+
+    if failed:
+        raise OSError(f'Pages are not placed as expected for {failed}.')
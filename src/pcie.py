@@ -2,23 +2,11 @@
 # SPDX-License-Identifier: GPL-2.0-or-later
 
 import errno
-import multiprocessing
 import os
 import re
-import sys
 
 from src import meta
-
-
-class SysfsError:
-    def __init__(self):
-        self._allow: dict[str, int] = {
-            'autosuspend_delay_ms': errno.EIO
-        }
-
-    @property
-    def allow(self) -> dict[str, int]:
-        return self._allow
+from src import tree
 
 
 def check_pcie_sysfs(watchdog: meta.Watchdog) -> None:
@@ -29,56 +17,36 @@ def check_pcie_sysfs(watchdog: meta.Watchdog) -> None:
     raise OSError('No PCIe root port found.')
 
 
-def consume_pcie_root(path: str, sysfs_error: SysfsError, save_errors: dict[str, int]) -> None:
-    count = 0
-    for root, dirs, files in os.walk(top=path):
-        # We are not going to read all devices' directories due to file-read many errors.
-        dirs[:] = [entry for entry in dirs if not re.match(r'[0-9a-z]+:[0-9a-z]+:[0-9a-z]+\.[0-9a-z]+', entry)]
-
-        for entry in files:
-            file = os.path.join(root, entry)
-            if os.access(file, os.R_OK):
-                # we might get decoding errors without 'b'.
-                f = open(file, 'rb')
-                try:
-                    count += 1
-                    f.read()
-                except OSError as e:
-                    if entry in sysfs_error.allow and sysfs_error.allow[entry] == e.errno:
-                        pass
-                    else:
-                        print(f'- Error: {file} - {e}', file=sys.stderr)
-                        save_errors[entry] = e.errno
-                finally:
-                    f.close()
-
-    sys.exit(count)
-
-
-def read_pcie_sysfs(watchdog: meta.Watchdog) -> None:
+def pcie_spec() -> tree.TreeSpec:
     sysfs = '/sys/devices/'
-    proc_map = {}
-    sysfs_error = SysfsError()
-    save_errors = multiprocessing.Manager().dict()
-    for entry in os.listdir(sysfs):
-        if not re.match(r'pci\d+:\d+', entry):
-            continue
-
-        root_path = os.path.join(sysfs, entry)
-        print(f'- Read files in {root_path}.')
-        proc = multiprocessing.Process(target=consume_pcie_root, daemon=True,
-                                       kwargs={'path': root_path, 'sysfs_error': sysfs_error,
-                                               'save_errors': save_errors})
-        proc.start()
-        proc_map[proc] = root_path
+    roots = [os.path.join(sysfs, entry) for entry in sorted(os.listdir(sysfs)) if re.match(r'pci\d+:\d+', entry)]
+    # We are not going to read all devices' directories due to file-read many errors.
+    return tree.TreeSpec(name='pcie', roots=tuple(roots), allow=(('*/autosuspend_delay_ms', errno.EIO),),
+                         skip=('[0-9a-z]*:[0-9a-z]*:[0-9a-z]*.[0-9a-z]*',))
 
-    # Ideally, we can convert those to non-blocking.
-    for proc in proc_map:
-        proc.join()
-        print(f'- Finish reading {proc_map[proc]} for {proc.exitcode} files.')
 
-    for file in save_errors:
-        print(f'- {file}: {os.strerror(save_errors[file])}')
-
-    if save_errors:
-        raise OSError(f'Caught the above exceptions.')
+@meta.case(2, name='Read all PCIe sysfs files.', timeout=30, tags=('io',), resources=('cpus',),
+           setup=check_pcie_sysfs)
+def read_pcie_sysfs(watchdog: meta.Watchdog) -> None:
+    tree.read_trees(spec=pcie_spec(), watchdog=watchdog)
+
+
+@meta.case(8, name='Read PCIe sysfs files concurrently.', timeout=60, tags=('io', 'slow'), resources=('cpus',),
+           setup=check_pcie_sysfs)
+def stress_pcie_sysfs(watchdog: meta.Watchdog) -> None:
+    """Read each attribute from many readers at the same time to exercise the drivers' locking."""
+    files = tree.list_files(spec=pcie_spec())
+    max_files = meta.param('pcie.stress.files', 50)
+    if len(files) > max_files:
+        # Spread the picks across the tree instead of only covering the first device.
+        files = files[::-(-len(files) // max_files)]
+
+    nr_readers = meta.param('pcie.stress.readers', min(len(os.sched_getaffinity(0)), 8))
+    print(f'- Stress {len(files)} files with up to {nr_readers} readers.')
+    bad = tree.stress_files(files=files, nr_readers=nr_readers, window=meta.param('pcie.stress.window', 0.01),
+                            collapse=meta.param('pcie.stress.collapse', 0.5),
+                            stall_ms=meta.param('pcie.stress.stall_ms', 100.0))
+    watchdog.metrics['files'] = len(files)
+    watchdog.metrics['bad_files'] = bad
+    if bad:
+        raise OSError(f'{len(bad)} files do not cope with concurrent readers.')
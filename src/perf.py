@@ -0,0 +1,133 @@
+# Copyright (c) 2022, Qualcomm Innovation Center, Inc. All rights reserved.
+# SPDX-License-Identifier: GPL-2.0-or-later
+
+import ctypes
+import errno
+import fcntl
+import os
+import resource
+import struct
+import sys
+import typing
+
+from src import counters
+from src import syscalls
+
+PERF_TYPE_HARDWARE = 0
+PERF_TYPE_SOFTWARE = 1
+PERF_FORMAT_TOTAL_TIME_ENABLED = 1 << 0
+PERF_FORMAT_TOTAL_TIME_RUNNING = 1 << 1
+PERF_EVENT_IOC_ENABLE = 0x2400
+PERF_EVENT_IOC_DISABLE = 0x2401
+PERF_IOC_FLAG_GROUP = 1
+
+# (name, type, config) with the software leader first, so the group works without hardware counters, e.g., in VMs.
+EVENTS = (
+    ('task_clock_ms', PERF_TYPE_SOFTWARE, 1),
+    ('page_faults', PERF_TYPE_SOFTWARE, 2),
+    ('context_switches', PERF_TYPE_SOFTWARE, 3),
+    ('cpu_migrations', PERF_TYPE_SOFTWARE, 4),
+    ('cycles', PERF_TYPE_HARDWARE, 0),
+    ('instructions', PERF_TYPE_HARDWARE, 1),
+)
+IO_KEYS = ['rchar', 'wchar', 'syscr', 'syscw', 'read_bytes', 'write_bytes']
+RUSAGE_KEYS = ('ru_utime', 'ru_stime', 'ru_minflt', 'ru_majflt', 'ru_nvcsw', 'ru_nivcsw', 'ru_inblock', 'ru_oublock')
+
+
+class PerfEventAttr(ctypes.Structure):
+    """The first 64 bytes of "struct perf_event_attr" known as PERF_ATTR_SIZE_VER0."""
+
+    _fields_ = [('type', ctypes.c_uint32), ('size', ctypes.c_uint32), ('config', ctypes.c_uint64),
+                ('sample_period', ctypes.c_uint64), ('sample_type', ctypes.c_uint64),
+                ('read_format', ctypes.c_uint64), ('flags', ctypes.c_uint64), ('reserved', ctypes.c_uint64 * 2)]
+
+    # Bits in "flags".
+    disabled: int = 1 << 0
+    inherit: int = 1 << 1
+    exclude_kernel: int = 1 << 5
+    exclude_hv: int = 1 << 6
+
+
+def open_event(event_type: int, config: int, group_fd: int, flags: int) -> int:
+    attr = PerfEventAttr(type=event_type, size=ctypes.sizeof(PerfEventAttr), config=config,
+                         read_format=PERF_FORMAT_TOTAL_TIME_ENABLED | PERF_FORMAT_TOTAL_TIME_RUNNING, flags=flags)
+    return syscalls.PERF_EVENT_OPEN(ctypes.byref(attr), 0, -1, group_fd, 0)
+
+
+def rusage() -> list[float]:
+    """Return the usage of this process plus its reaped children."""
+    usages = (resource.getrusage(resource.RUSAGE_SELF), resource.getrusage(resource.RUSAGE_CHILDREN))
+    return [sum(getattr(usage, key) for usage in usages) for key in RUSAGE_KEYS]
+
+
+class Profiler:
+    """Measure what a phase of a test case costs the kernel with a perf counter group, "/proc/self/io" and getrusage().
+
+    Everything is opened at the start of each phase, so it follows whichever process runs the phase, including forked
+    workers. The counters are inherited by threads and children created during the phase.
+    """
+
+    def __init__(self) -> None:
+        # Count user space only after an EACCES from "perf_event_paranoid" for unprivileged users.
+        self._flags: int = PerfEventAttr.inherit
+        self._unavailable: typing.Optional[str] = None
+        self._fds: list[tuple[str, int]] = []
+        self._io: typing.Optional[counters.Counters] = None
+        self._io_start: typing.Optional[counters.Snapshot] = None
+        self._rusage: list[float] = []
+
+    def open_group(self) -> None:
+        leader = -1
+        for name, event_type, config in EVENTS:
+            try:
+                fd = open_event(event_type, config, leader, self._flags | (PerfEventAttr.disabled if leader < 0 else 0))
+            except OSError as e:
+                if leader < 0 and e.errno == errno.EACCES and not self._flags & PerfEventAttr.exclude_kernel:
+                    self._flags |= PerfEventAttr.exclude_kernel | PerfEventAttr.exclude_hv
+                    return self.open_group()
+                if leader < 0:
+                    self._unavailable = str(e)
+                    print(f'- No perf counters: {e}.', file=sys.stderr)
+                    return
+                # No hardware counters, so carry on with the software ones.
+                continue
+
+            if leader < 0:
+                leader = fd
+            self._fds.append((name, fd))
+
+    def start(self) -> None:
+        if self._unavailable is None:
+            self.open_group()
+        self._io = counters.Counters()
+        self._io.add('io', '/proc/self/io', keys=IO_KEYS)
+        self._io_start = self._io.snapshot()
+        self._rusage = rusage()
+        if self._fds:
+            fcntl.ioctl(self._fds[0][1], PERF_EVENT_IOC_ENABLE, PERF_IOC_FLAG_GROUP)
+
+    def stop(self) -> dict[str, float]:
+        costs = {}
+        if self._fds:
+            fcntl.ioctl(self._fds[0][1], PERF_EVENT_IOC_DISABLE, PERF_IOC_FLAG_GROUP)
+        for name, fd in self._fds:
+            value, enabled, running = struct.unpack('QQQ', os.read(fd, 24))
+            os.close(fd)
+            # Scale it up if the counter was multiplexed with others.
+            if running and running < enabled:
+                value = value * enabled // running
+            costs[name] = value / 1e6 if name == 'task_clock_ms' else value
+        self._fds = []
+        if costs.get('cycles'):
+            costs['ipc'] = round(costs.get('instructions', 0) / costs['cycles'], 3)
+
+        costs.update(self._io.delta(self._io_start, self._io.snapshot()).as_dict())
+        self._io.close()
+        for key, old, new in zip(RUSAGE_KEYS, self._rusage, rusage()):
+            costs[key[len('ru_'):]] = round(new - old, 6)
+
+        return costs
+
+    @staticmethod
+    def format(costs: dict[str, float]) -> str:
+        return ', '.join(f'{name} {value:g}' for name, value in costs.items())
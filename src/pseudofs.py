@@ -0,0 +1,53 @@
+# Copyright (c) 2022, Qualcomm Innovation Center, Inc. All rights reserved.
+# SPDX-License-Identifier: GPL-2.0-or-later
+
+import errno
+import os
+
+from src import meta
+from src import tree
+
+# Symlinks pointing back to their subsystems, drivers and alike would take us to the whole sysfs.
+SYSFS_BACKLINKS = ('subsystem', 'driver', 'module', 'firmware_node', 'of_node', 'iommu_group', 'iommu', 'bdi',
+                   'consumer:*', 'supplier:*', 'port', 'physfn', 'virtfn*')
+
+# Runtime PM is not enabled for most devices.
+SYSFS_ALLOW = (('*/autosuspend_delay_ms', errno.EIO),)
+
+SYSTEM_SPEC = tree.TreeSpec(name='system', roots=('/sys/devices/system',), follow=True, skip=SYSFS_BACKLINKS,
+                            allow=SYSFS_ALLOW)
+
+CLASS_SPEC = tree.TreeSpec(name='class', roots=('/sys/class',), follow=True, skip=SYSFS_BACKLINKS,
+                           # Those depend on whether the link is up or the device supports it.
+                           allow=SYSFS_ALLOW + (('/sys/class/net/*', errno.EINVAL), ('/sys/class/net/*', errno.ENOENT),
+                                                ('/sys/class/net/*', errno.EOPNOTSUPP)))
+
+PROC_SYS_SPEC = tree.TreeSpec(name='procsys', roots=('/proc/sys',),
+                              allow=(('/proc/sys/*', errno.EPERM), ('/proc/sys/*', errno.EACCES),
+                                     # It is only there once written.
+                                     ('/proc/sys/net/ipv6/conf/*/stable_secret', errno.EIO)))
+
+
+@meta.case(4, name='Read all system sysfs files.', timeout=30, tags=('io',), resources=('cpus',))
+def read_system_sysfs(watchdog: meta.Watchdog) -> None:
+    tree.read_trees(spec=SYSTEM_SPEC, watchdog=watchdog)
+
+
+@meta.case(5, name='Read all class sysfs files.', timeout=30, tags=('io',), resources=('cpus',))
+def read_class_sysfs(watchdog: meta.Watchdog) -> None:
+    tree.read_trees(spec=CLASS_SPEC, watchdog=watchdog)
+
+
+@meta.case(6, name='Read all sysctl files.', timeout=30, tags=('io',), resources=('cpus',))
+def read_proc_sys(watchdog: meta.Watchdog) -> None:
+    tree.read_trees(spec=PROC_SYS_SPEC, watchdog=watchdog)
+
+
+@meta.case(7, name='Read all procfs files of a process.', timeout=30, tags=('io',), resources=('cpus',))
+def read_proc_pid(watchdog: meta.Watchdog) -> None:
+    # Threads could come and go, and the workers are not allowed to look at some files of another process.
+    spec = tree.TreeSpec(name='procpid', roots=(f'/proc/{os.getpid()}',),
+                         skip=('pagemap', 'mem', 'clear_refs', 'kcore', 'cwd', 'root', 'exe', 'fd', 'map_files'),
+                         allow=(('/proc/*', errno.EACCES), ('/proc/*', errno.EPERM), ('/proc/*', errno.ENOENT),
+                                ('/proc/*', errno.ESRCH), ('/proc/*', errno.EINVAL)))
+    tree.read_trees(spec=spec, watchdog=watchdog)
@@ -0,0 +1,90 @@
+# Copyright (c) 2022, Qualcomm Innovation Center, Inc. All rights reserved.
+# SPDX-License-Identifier: GPL-2.0-or-later
+
+from __future__ import annotations
+
+import array
+import dataclasses
+import json
+import os
+import time
+import typing
+import xml.etree.ElementTree as ET
+
+from src import meta
+
+
+def encode(value: typing.Any) -> typing.Any:
+    """Make whatever the test cases put in their metrics fit into JSON."""
+    if isinstance(value, array.array):
+        return value.tolist()
+    if dataclasses.is_dataclass(value):
+        return dataclasses.asdict(value)
+
+    return str(value)
+
+
+class Reporter:
+    """Machine-readable results on a file descriptor of their own, so they won't mix with the human-readable output.
+
+    "ndjson" streams one JSON line per event as it happens, including from forked workers, as every line is written
+    at once. "junit" writes one XML document at the end.
+    """
+
+    formats: tuple[str, ...] = ('ndjson', 'junit')
+
+    def __init__(self, fmt: str, fd: int) -> None:
+        assert fmt in self.formats
+        self._format: str = fmt
+        self._fd: int = fd
+        self._start: float = time.monotonic()
+        self._results: list[meta.TestResult] = []
+
+    def emit(self, event: str, **fields: typing.Any) -> None:
+        if self._format != 'ndjson':
+            return
+
+        line = json.dumps({'event': event, 'time': time.monotonic(), 'pid': os.getpid(), **fields}, default=encode)
+        os.write(self._fd, line.encode() + b'\n')
+
+    def start(self, test_case: meta.TestCase) -> None:
+        self.emit('start', case=test_case.name, timeout=test_case.timeout)
+
+    def phase(self, test_case: meta.TestCase, phase: str, duration: float,
+              error: typing.Optional[BaseException]) -> None:
+        self.emit('phase', case=test_case.name, phase=phase, duration=duration,
+                  error=None if error is None else str(error))
+
+    def finish(self, result: meta.TestResult) -> None:
+        self._results.append(result)
+        self.emit('finish', case=result.name, duration=sum(result.phases.values()), passed=result.passed,
+                  error=result.error, phases=result.phases, metrics=result.metrics, costs=result.costs,
+                  children=result.children)
+
+    def junit(self) -> bytes:
+        suite = ET.Element('testsuite', name='lsbug', tests=str(len(self._results)),
+                           failures=str(sum(not result.passed for result in self._results)),
+                           time=f'{time.monotonic() - self._start:.3f}')
+        for result in self._results:
+            case = ET.SubElement(suite, 'testcase', classname='lsbug', name=result.name,
+                                 time=f'{sum(result.phases.values()):.3f}')
+            properties = ET.SubElement(case, 'properties')
+            for name, value in result.metrics.items():
+                ET.SubElement(properties, 'property', name=name, value=json.dumps(value, default=encode))
+            for phase, costs in result.costs.items():
+                for name, value in costs.items():
+                    ET.SubElement(properties, 'property', name=f'{phase}.{name}', value=str(value))
+            if not result.passed:
+                ET.SubElement(case, 'failure', message=result.error)
+            ET.SubElement(case, 'system-out').text = result.stdout
+            ET.SubElement(case, 'system-err').text = result.stderr
+
+        return ET.tostring(suite, encoding='utf-8', xml_declaration=True) + b'\n'
+
+    def close(self) -> None:
+        failed = sum(not result.passed for result in self._results)
+        self.emit('summary', passed=len(self._results) - failed, failed=failed,
+                  duration=time.monotonic() - self._start)
+        if self._format == 'junit':
+            os.write(self._fd, self.junit())
+        os.close(self._fd)
@@ -0,0 +1,92 @@
+# Copyright (c) 2022, Qualcomm Innovation Center, Inc. All rights reserved.
+# SPDX-License-Identifier: GPL-2.0-or-later
+
+import select
+import sys
+import time
+
+from src import meta
+from src import worker
+
+
+class Scheduler:
+    """Run test cases concurrently in isolated workers, and serialize those sharing an exclusive resource."""
+
+    def __init__(self, jobs: int, watchdog: meta.Watchdog, server: worker.ForkServer) -> None:
+        assert jobs > 0
+        self._jobs: int = jobs
+        self._watchdog: meta.Watchdog = watchdog
+        self._server: worker.ForkServer = server
+        self._running: list[worker.Worker] = []
+        self._held: set[str] = set()
+        self._results: list[meta.TestResult] = []
+
+    @property
+    def jobs(self) -> int:
+        return self._jobs
+
+    @property
+    def results(self) -> list[meta.TestResult]:
+        return self._results
+
+    @property
+    def failed(self) -> list[meta.TestResult]:
+        return [result for result in self._results if not result.passed]
+
+    def runnable(self, test_case: meta.TestCase) -> bool:
+        return len(self._running) < self._jobs and not (test_case.resources & self._held)
+
+    def start(self, test_case: meta.TestCase) -> None:
+        print(f'- Start test case: {test_case.name}')
+        proc = self._server.submit(test_case)
+        self._watchdog.add_pid(proc.pid)
+        self._running.append(proc)
+        self._held.update(test_case.resources)
+
+    def finish(self, proc: worker.Worker) -> None:
+        result = proc.finish()
+        self._watchdog.del_pid(proc.pid)
+        self._running.remove(proc)
+        self._held.difference_update(proc.test_case.resources)
+        self._results.append(result)
+
+        # Print the whole output at once, so concurrent test cases won't interleave.
+        print(result.stdout, end='')
+        print(result.stderr, end='', file=sys.stderr)
+        meta.report(result)
+
+    def reap(self) -> None:
+        """Wait until at least one worker is finished or killed."""
+        while True:
+            finished = [proc for proc in self._running if proc.done or proc.expire()]
+            for proc in finished:
+                self.finish(proc)
+            if finished:
+                return
+
+            fd_map = {fd: proc for proc in self._running for fd in proc.fds}
+            deadlines = [proc.deadline for proc in self._running if proc.deadline is not None]
+            timeout = max(0.0, min(deadlines) - time.monotonic()) if deadlines else None
+            for fd in select.select(list(fd_map), [], [], timeout)[0]:
+                fd_map[fd].feed(fd)
+
+    def run(self, test_cases: list[meta.TestCase]) -> list[meta.TestResult]:
+        """Return the results of this run in the order they finish."""
+        pending = list(test_cases)
+        first = len(self._results)
+        wall_start = time.monotonic()
+        while pending or self._running:
+            # Keep the original order as much as possible, but let later cases overtake blocked ones.
+            for test_case in list(pending):
+                if self.runnable(test_case):
+                    pending.remove(test_case)
+                    self.start(test_case)
+
+            self.reap()
+
+        wall = time.monotonic() - wall_start
+        results = self._results[first:]
+        serial = sum(sum(result.phases.values()) for result in results)
+        print(f'- Finish {len(results)} test cases with {self._jobs} jobs in {wall:.3f}s '
+              f'instead of {serial:.3f}s serially ({serial / wall if wall else 1:.2f}x).')
+        return results
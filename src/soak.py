@@ -0,0 +1,127 @@
+# Copyright (c) 2022, Qualcomm Innovation Center, Inc. All rights reserved.
+# SPDX-License-Identifier: GPL-2.0-or-later
+
+from __future__ import annotations
+
+import array
+import math
+import statistics
+import sys
+import time
+import typing
+
+from src import meta
+from src import stats
+
+PHASES = ('setup', 'run', 'cleanup')
+
+
+class History:
+    """Wall time of every phase in every iteration of a test case, with NaN for phases never reached."""
+
+    def __init__(self, capacity: int) -> None:
+        self._times: array.array = array.array('d', [math.nan]) * (capacity * len(PHASES))
+        self._count: int = 0
+        self._failures: int = 0
+
+    @property
+    def count(self) -> int:
+        return self._count
+
+    @property
+    def failures(self) -> int:
+        return self._failures
+
+    def add(self, result: meta.TestResult) -> None:
+        if self._count * len(PHASES) == len(self._times):
+            # Only happens with "--duration", which can't know the number of iterations in advance.
+            self._times.extend(array.array('d', [math.nan]) * len(self._times))
+
+        for index, phase in enumerate(PHASES):
+            if phase in result.phases:
+                self._times[self._count * len(PHASES) + index] = result.phases[phase]
+        self._count += 1
+        if not result.passed:
+            self._failures += 1
+
+    def phase(self, phase: str) -> list[float]:
+        values = self._times[PHASES.index(phase):self._count * len(PHASES):len(PHASES)]
+        return [value for value in values if not math.isnan(value)]
+
+    def totals(self) -> list[float]:
+        """Return the time of each iteration which has finished all phases."""
+        width = len(PHASES)
+        rows = (self._times[start:start + width] for start in range(0, self._count * width, width))
+        return [sum(row) for row in rows if not any(math.isnan(value) for value in row)]
+
+    def drift(self) -> typing.Optional[float]:
+        """Return how much slower the last quarter of the iterations is than the first quarter, e.g., 0.5 for 50%.
+
+        Medians keep a few noisy iterations from looking like a trend.
+        """
+        totals = self.totals()
+        quarter = len(totals) // 4
+        if quarter < 2:
+            return None
+
+        first = statistics.median(totals[:quarter])
+        last = statistics.median(totals[-quarter:])
+        return (last - first) / first if first else None
+
+
+class Soak:
+    """Run the same test cases over and over for a number of iterations or a period of time."""
+
+    # Don't bother with a tiny drift, which could simply be noise.
+    drift: float = 0.2
+
+    def __init__(self, test_cases: list[meta.TestCase], repeat: int = 0, duration: float = 0) -> None:
+        assert repeat > 0 or duration > 0
+        self._test_cases: list[meta.TestCase] = test_cases
+        self._repeat: int = repeat
+        self._duration: float = duration
+        self._histories: dict[str, History] = {test_case.name: History(repeat or 1024) for test_case in test_cases}
+        self._iterations: int = 0
+
+    @property
+    def failed(self) -> bool:
+        return any(history.failures for history in self._histories.values()) or bool(self.drifting())
+
+    def run(self, one_pass: typing.Callable[[], list[meta.TestResult]]) -> None:
+        deadline = time.monotonic() + self._duration if self._duration else math.inf
+        while (not self._repeat or self._iterations < self._repeat) and time.monotonic() < deadline:
+            self._iterations += 1
+            print(f'- Start iteration {self._iterations}.')
+            for result in one_pass():
+                self._histories[result.name].add(result)
+
+    def drifting(self) -> list[str]:
+        return [name for name, history in self._histories.items()
+                if (drift := history.drift()) is not None and drift > meta.param('soak.drift', self.drift)]
+
+    def report(self) -> None:
+        print(f'- Finish {self._iterations} iterations.')
+        for name, history in self._histories.items():
+            print(f'- Test case "{name}": {history.failures} of {history.count} iterations failed '
+                  f'({history.failures / history.count if history.count else 0:.1%}).')
+            for phase in PHASES:
+                times = history.phase(phase)
+                if times:
+                    print(f'-   {phase}: min {min(times):.3f}s, p50 {stats.percentile(times, 50):.3f}s, '
+                          f'p99 {stats.percentile(times, 99):.3f}s, max {max(times):.3f}s')
+
+        for name in self.drifting():
+            print(f'- Error: test case "{name}" is {self._histories[name].drift():.0%} slower in the last quarter of '
+                  f'the iterations than the first quarter.', file=sys.stderr)
+
+
+def execute_all(test_cases: list[meta.TestCase], watchdog: meta.Watchdog) -> list[meta.TestResult]:
+    """Run test cases one by one in this process, and carry on after any failure."""
+    results = []
+    for test_case in test_cases:
+        print(f'- Start test case: {test_case.name}')
+        result = meta.execute(test_case, watchdog)
+        meta.report(result)
+        results.append(result)
+
+    return results
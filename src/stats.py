@@ -0,0 +1,69 @@
+# Copyright (c) 2022, Qualcomm Innovation Center, Inc. All rights reserved.
+# SPDX-License-Identifier: GPL-2.0-or-later
+
+from __future__ import annotations
+
+import array
+import typing
+
+
+class Histogram:
+    """A compact latency histogram with power-of-two buckets in nanoseconds."""
+
+    # The last bucket is for anything from about 9 seconds.
+    nr_buckets: int = 34
+
+    def __init__(self) -> None:
+        self._buckets: array.array = array.array('Q', bytes(8 * self.nr_buckets))
+        self._count: int = 0
+        self._total: int = 0
+        self._max: int = 0
+
+    @property
+    def count(self) -> int:
+        return self._count
+
+    @property
+    def max(self) -> int:
+        return self._max
+
+    @property
+    def mean(self) -> float:
+        return self._total / self._count if self._count else 0
+
+    def add(self, ns: int) -> None:
+        self._buckets[min(ns.bit_length(), self.nr_buckets - 1)] += 1
+        self._count += 1
+        self._total += ns
+        self._max = max(self._max, ns)
+
+    def merge(self, other: Histogram) -> None:
+        for index, value in enumerate(other._buckets):
+            self._buckets[index] += value
+        self._count += other._count
+        self._total += other._total
+        self._max = max(self._max, other._max)
+
+    def percentile(self, pct: float) -> int:
+        """Return the upper bound of the bucket holding the percentile."""
+        target = self._count * pct / 100
+        seen = 0
+        for index, value in enumerate(self._buckets):
+            seen += value
+            if value and seen >= target:
+                return min(1 << index, self._max)
+
+        return self._max
+
+    def __str__(self) -> str:
+        return (f'{self._count} reads, mean {self.mean / 1000:.1f} us, p50 {self.percentile(50) / 1000:.1f} us, '
+                f'p99 {self.percentile(99) / 1000:.1f} us, max {self._max / 1000:.1f} us')
+
+
+def percentile(values: typing.Sequence[float], pct: float) -> float:
+    """Return the nearest-rank percentile of some values."""
+    ordered = sorted(values)
+    if not ordered:
+        return 0
+
+    return ordered[min(len(ordered) - 1, max(0, int(len(ordered) * pct / 100 + 0.5) - 1))]
@@ -0,0 +1,82 @@
+# Copyright (c) 2022, Qualcomm Innovation Center, Inc. All rights reserved.
+# SPDX-License-Identifier: GPL-2.0-or-later
+
+import ctypes
+import ctypes.util
+import os
+import platform
+import typing
+
+# arm64 uses "include/uapi/asm-generic/unistd.h", and x86_64 uses "arch/x86/entry/syscalls/syscall_64.tbl".
+NUMBERS = {
+    'aarch64': {
+        'mbind': 235,
+        'get_mempolicy': 236,
+        'set_mempolicy': 237,
+        'migrate_pages': 238,
+        'move_pages': 239,
+        'perf_event_open': 241,
+    },
+    'x86_64': {
+        'mbind': 237,
+        'get_mempolicy': 239,
+        'set_mempolicy': 238,
+        'migrate_pages': 256,
+        'move_pages': 279,
+        'perf_event_open': 298,
+    },
+}
+
+_libc = ctypes.CDLL(name=ctypes.util.find_library('c'), use_errno=True)
+
+
+def number(name: str) -> int:
+    machine = platform.machine()
+    if machine not in NUMBERS:
+        raise OSError(f'No system call numbers for {machine}.')
+
+    return NUMBERS[machine][name]
+
+
+class Syscall:
+    """A system call with its own prototype built once, so calling it is cheap and safe from any thread.
+
+    Setting "argtypes" on the shared libc "syscall" function instead costs time for each call, and races with other
+    threads calling a different system call.
+    """
+
+    def __init__(self, name: str, restype: typing.Any, argtypes: list[typing.Any]) -> None:
+        self._name: str = name
+        self._nr: int = number(name)
+        prototype = ctypes.CFUNCTYPE(restype, ctypes.c_long, *argtypes, use_errno=True)
+        self._func: typing.Callable[..., typing.Any] = prototype(('syscall', _libc))
+
+    @property
+    def name(self) -> str:
+        return self._name
+
+    @property
+    def nr(self) -> int:
+        return self._nr
+
+    def __call__(self, *args: typing.Any) -> typing.Any:
+        ret = self._func(self._nr, *args)
+        if ret < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, f'error from {self._name}(): {os.strerror(err)}')
+
+        return ret
+
+
+MBIND = Syscall('mbind', ctypes.c_long, [ctypes.c_void_p, ctypes.c_ulong, ctypes.c_int, ctypes.POINTER(ctypes.c_ulong),
+                                         ctypes.c_ulong, ctypes.c_uint])
+GET_MEMPOLICY = Syscall('get_mempolicy', ctypes.c_long, [ctypes.POINTER(ctypes.c_int), ctypes.POINTER(ctypes.c_ulong),
+                                                         ctypes.c_ulong, ctypes.c_void_p, ctypes.c_int])
+SET_MEMPOLICY = Syscall('set_mempolicy', ctypes.c_long, [ctypes.c_int, ctypes.POINTER(ctypes.c_ulong), ctypes.c_ulong])
+MIGRATE_PAGES = Syscall('migrate_pages', ctypes.c_long, [ctypes.c_int, ctypes.c_ulong, ctypes.POINTER(ctypes.c_ulong),
+                                                         ctypes.POINTER(ctypes.c_ulong)])
+MOVE_PAGES = Syscall('move_pages', ctypes.c_long, [ctypes.c_int, ctypes.c_ulong, ctypes.POINTER(ctypes.c_void_p),
+                                                   ctypes.POINTER(ctypes.c_int), ctypes.POINTER(ctypes.c_int),
+                                                   ctypes.c_int])
+PERF_EVENT_OPEN = Syscall('perf_event_open', ctypes.c_long, [ctypes.c_void_p, ctypes.c_int, ctypes.c_int, ctypes.c_int,
+                                                             ctypes.c_ulong])
@@ -0,0 +1,127 @@
+# Copyright (c) 2022, Qualcomm Innovation Center, Inc. All rights reserved.
+# SPDX-License-Identifier: GPL-2.0-or-later
+
+import array
+import ctypes
+import mmap
+import os
+import resource
+import sys
+import time
+
+from src import counters
+from src import meta
+from src import stats
+from src import utils
+
+HPAGE_SIZE = 2 << 20
+
+
+def check_thp(watchdog: meta.Watchdog) -> None:
+    enabled = open('/sys/kernel/mm/transparent_hugepage/enabled').read()
+    print(f'- THP is "{enabled.rstrip()}".')
+    if '[never]' in enabled:
+        raise OSError('THP is disabled.')
+
+    if not hasattr(mmap.mmap, 'madvise'):
+        raise OSError('mmap.madvise() needs Python 3.8+.')
+
+
+def fault_region(size: int, huge: bool) -> tuple[float, array.array]:
+    """Fault a region one 4K page at a time, and return the seconds taken plus the latency of each 2M chunk in ns."""
+    page_size = resource.getpagesize()
+    # Leave room to align it for huge pages.
+    with mmap.mmap(-1, size + HPAGE_SIZE) as mm:
+        buffer = ctypes.c_char.from_buffer(mm)
+        offset = -ctypes.addressof(buffer) % HPAGE_SIZE
+        del buffer
+        mm.madvise(mmap.MADV_HUGEPAGE if huge else mmap.MADV_NOHUGEPAGE)
+
+        view = memoryview(mm)[offset:offset + size]
+        latencies = array.array('q')
+        ones = b'\x01' * (HPAGE_SIZE // page_size)
+        start = time.perf_counter_ns()
+        for chunk in range(0, size, HPAGE_SIZE):
+            begin = time.perf_counter_ns()
+            # The slicing runs in C, so we mostly measure the page faults.
+            view[chunk:chunk + HPAGE_SIZE:page_size] = ones
+            latencies.append(time.perf_counter_ns() - begin)
+        elapsed = (time.perf_counter_ns() - start) / 1e9
+        view.release()
+
+    return elapsed, latencies
+
+
+def run_faulters(watchdog: meta.Watchdog, cpus: list[int], size: int, huge: bool) -> tuple[float, array.array]:
+    """Fault private regions from processes pinned to the CPUs at the same time, and return GB/s and latencies."""
+    pipes = []
+    for cpu in cpus:
+        reader, writer = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            os.close(reader)
+            os.sched_setaffinity(0, [cpu])
+            elapsed, latencies = fault_region(size=size, huge=huge)
+            os.write(writer, array.array('d', [elapsed]).tobytes() + latencies.tobytes())
+            os._exit(os.EX_OK)
+
+        os.close(writer)
+        watchdog.add_child(pid)
+        pipes.append((pid, reader))
+
+    slowest = 0.0
+    latencies = array.array('q')
+    for pid, reader in pipes:
+        data = b''
+        while chunk := os.read(reader, 65536):
+            data += chunk
+        os.close(reader)
+        watchdog.del_child(pid)
+        if len(data) < 8:
+            raise OSError(f'The faulting process {pid} died.')
+        slowest = max(slowest, array.array('d', data[:8])[0])
+        latencies.frombytes(data[8:])
+
+    return size * len(cpus) / slowest / 1e9, latencies
+
+
+@meta.case(13, name='Fault in transparent huge pages.', timeout=60, tags=('memory',), resources=('cpus', 'memory'),
+           setup=check_thp)
+def fault_thp(watchdog: meta.Watchdog) -> None:
+    cpus = utils.online_cpus()[:meta.param('thp.workers', 4)]
+    size = meta.param('thp.mb', 256) << 20
+    ratio = meta.param('thp.ratio', 1.0)
+    results = {}
+    deltas = {}
+    vmstat = counters.Counters()
+    vmstat.add('vmstat', '/proc/vmstat', keys=['thp_fault_alloc', 'thp_fault_fallback'])
+    for huge in (False, True):
+        old = vmstat.snapshot()
+        results[huge] = run_faulters(watchdog=watchdog, cpus=cpus, size=size, huge=huge)
+        deltas[huge] = vmstat.delta(old, vmstat.snapshot())
+
+        name = 'THP' if huge else '4K'
+        rate, latencies = results[huge]
+        print(f'- {name} pages from {len(cpus)} CPUs: {rate:.2f} GB/s, 2M chunk latency '
+              f'p50 {stats.percentile(latencies, 50) / 1000:.1f} us, '
+              f'p99 {stats.percentile(latencies, 99) / 1000:.1f} us, {deltas[huge].as_dict()}.')
+        watchdog.metrics[f'{name}_gbps'] = rate
+
+    vmstat.close()
+
+    errors = []
+    expect = size * len(cpus) // HPAGE_SIZE
+    # Other processes could fault huge pages as well, so only check the lower bound.
+    allocated = deltas[True]['vmstat.thp_fault_alloc']
+    fallback = deltas[True]['vmstat.thp_fault_fallback']
+    if allocated < expect * 0.9:
+        errors.append(f'only {allocated} of {expect} huge pages were allocated')
+    if fallback > expect * 0.1:
+        errors.append(f'{fallback} huge page faults fell back')
+    if results[True][0] < results[False][0] * ratio:
+        errors.append(f'THP faults at {results[True][0]:.2f} GB/s instead of {ratio}x of 4K pages')
+
+    for error in errors:
+        print(f'- Error: {error}.', file=sys.stderr)
+    if errors:
+        raise OSError('THP page faults regressed.')
@@ -0,0 +1,131 @@
+# Copyright (c) 2022, Qualcomm Innovation Center, Inc. All rights reserved.
+# SPDX-License-Identifier: GPL-2.0-or-later
+
+from __future__ import annotations
+
+import array
+import contextlib
+import itertools
+import json
+import os
+import threading
+import time
+import typing
+
+# (name, begin ns, end ns, pid, tid) in CLOCK_MONOTONIC, which all processes share.
+Span = typing.Tuple[str, int, int, int, int]
+
+
+class Tracer:
+    """Spans of one process kept in a ring buffer preallocated once, plus those merged from its child processes.
+
+    When the ring is full, the oldest spans are overwritten instead of growing without bounds.
+    """
+
+    # begin, end, name index, pid and tid
+    width: int = 5
+
+    def __init__(self, capacity: int) -> None:
+        self._capacity: int = capacity
+        self._ring: array.array = array.array('q', bytes(8 * self.width * capacity))
+        self._count: int = 0
+        # next() on it is atomic, so threads never claim the same slot.
+        self._indexes: typing.Iterator[int] = itertools.count()
+        self._names: list[str] = []
+        self._ids: dict[str, int] = {}
+        self._merged: list[Span] = []
+
+    @property
+    def dropped(self) -> int:
+        return max(0, self._count - self._capacity)
+
+    def reset(self) -> None:
+        self._count = 0
+        self._indexes = itertools.count()
+        self._merged = []
+
+    def record(self, name: str, begin: int, end: int, pid: typing.Optional[int] = None,
+               tid: typing.Optional[int] = None) -> None:
+        if name not in self._ids:
+            self._ids[name] = len(self._names)
+            self._names.append(name)
+
+        index = next(self._indexes)
+        slot = index % self._capacity * self.width
+        ring = self._ring
+        ring[slot] = begin
+        ring[slot + 1] = end
+        ring[slot + 2] = self._ids[name]
+        ring[slot + 3] = os.getpid() if pid is None else pid
+        ring[slot + 4] = threading.get_native_id() if tid is None else tid
+        self._count = max(self._count, index + 1)
+
+    @contextlib.contextmanager
+    def span(self, name: str) -> typing.Iterator[None]:
+        begin = time.monotonic_ns()
+        try:
+            yield
+        finally:
+            self.record(name, begin, time.monotonic_ns())
+
+    def merge(self, spans: list[Span]) -> None:
+        self._merged.extend(spans)
+
+    def export(self) -> list[Span]:
+        """Return and forget all spans, so they can be handed to the parent process."""
+        spans = self._merged
+        for index in range(max(0, self._count - self._capacity), self._count):
+            slot = index % self._capacity * self.width
+            begin, end, name, pid, tid = self._ring[slot:slot + self.width]
+            spans.append((self._names[name], begin, end, pid, tid))
+        self.reset()
+        return spans
+
+
+_tracer: typing.Optional[Tracer] = None
+
+
+def enable(capacity: int) -> None:
+    global _tracer
+    _tracer = Tracer(capacity)
+    # A forked child starts with an empty ring, and hands its spans back to the parent.
+    os.register_at_fork(after_in_child=_tracer.reset)
+
+
+def enabled() -> bool:
+    return _tracer is not None
+
+
+def span(name: str) -> typing.ContextManager[None]:
+    """Time a block of code, which costs almost nothing without "-d"."""
+    if _tracer is None:
+        return contextlib.nullcontext()
+
+    return _tracer.span(name)
+
+
+def record(name: str, begin: int, end: int, pid: typing.Optional[int] = None) -> None:
+    """Record a span measured by hand, e.g., the lifetime of a child process which can't report its own."""
+    if _tracer is not None:
+        _tracer.record(name, begin, end, pid=pid, tid=pid)
+
+
+def export() -> list[Span]:
+    return _tracer.export() if _tracer is not None else []
+
+
+def merge(spans: list[Span]) -> None:
+    if _tracer is not None:
+        _tracer.merge(spans)
+
+
+def write(path: str) -> int:
+    """Write all spans as a Chrome trace JSON file, which Perfetto opens as well, and return the number of them."""
+    dropped = _tracer.dropped
+    spans = export()
+    events = [{'name': name, 'ph': 'X', 'ts': begin / 1000, 'dur': (end - begin) / 1000, 'pid': pid, 'tid': tid}
+              for name, begin, end, pid, tid in spans]
+    with open(path, 'w') as f:
+        json.dump({'traceEvents': events, 'displayTimeUnit': 'ns', 'otherData': {'dropped': dropped}}, f)
+
+    return len(events)
@@ -0,0 +1,365 @@
+# Copyright (c) 2022, Qualcomm Innovation Center, Inc. All rights reserved.
+# SPDX-License-Identifier: GPL-2.0-or-later
+
+from __future__ import annotations
+
+import ctypes
+import dataclasses
+import fnmatch
+import heapq
+import multiprocessing
+import multiprocessing.connection
+import os
+import queue
+import re
+import sys
+import time
+import typing
+
+from src import meta
+from src import stats
+from src import trace
+
+
+@dataclasses.dataclass(frozen=True)
+class TreeSpec:
+    """What to read from sysfs, procfs and alike."""
+    # It is also the prefix of the tunables, e.g., "pcie.slow_ms".
+    name: str
+    roots: tuple[str, ...]
+    # (glob on the whole path, errno) for any expected read error.
+    allow: tuple[tuple[str, int], ...] = ()
+    # Globs on entry names to leave alone, e.g., huge or side-effecting files.
+    skip: tuple[str, ...] = ()
+    # Whether to walk into symlinked directories. Each directory is still only read once.
+    follow: bool = False
+
+
+class Matcher:
+    """Compile the globs once, so we only pay for one regex match per entry."""
+
+    def __init__(self, spec: TreeSpec) -> None:
+        self._skip: typing.Optional[re.Pattern] = (
+            re.compile('|'.join(fnmatch.translate(glob) for glob in spec.skip)) if spec.skip else None)
+        self._allow: dict[int, re.Pattern] = {}
+        for err in {err for _, err in spec.allow}:
+            self._allow[err] = re.compile('|'.join(fnmatch.translate(glob) for glob, e in spec.allow if e == err))
+
+    def skip(self, name: str) -> bool:
+        return bool(self._skip and self._skip.match(name))
+
+    def allow(self, file: str, err: int) -> bool:
+        return err in self._allow and bool(self._allow[err].match(file))
+
+
+class InodeIndex:
+    """A fixed-size open-addressing set of directory inodes in shared memory, so workers won't read one twice."""
+
+    def __init__(self, size: int) -> None:
+        # Keep it a power of 2 for cheap modulo.
+        self._size: int = 1 << max(size - 1, 1).bit_length()
+        self._table: multiprocessing.Array = multiprocessing.Array(ctypes.c_uint64, self._size)
+
+    def add(self, st: os.stat_result) -> bool:
+        """Return whether the inode is new."""
+        # Zero means an empty slot.
+        key = ((st.st_dev << 40) ^ st.st_ino) & 0xffffffffffffffff or 1
+        mask = self._size - 1
+        slot = (key * 0x9e3779b97f4a7c15 >> 32) & mask
+        with self._table.get_lock():
+            table = self._table.get_obj()
+            for _ in range(self._size):
+                if table[slot] == key:
+                    return False
+                if table[slot] == 0:
+                    table[slot] = key
+                    return True
+                slot = (slot + 1) & mask
+
+        raise RuntimeError(f'More than {self._size} directories to read, so increase the inode index.')
+
+
+class ReadStats:
+    """Latency of every open and read per root and per attribute name, plus the slowest files."""
+
+    def __init__(self, top: int, slow_ns: int) -> None:
+        self._top: int = top
+        self._slow_ns: int = slow_ns
+        self._roots: dict[str, stats.Histogram] = {}
+        self._attrs: dict[str, stats.Histogram] = {}
+        # A min-heap of (latency, file), so the fastest one is replaced first.
+        self._slowest: list[tuple[int, str]] = []
+        self._over: list[tuple[int, str]] = []
+
+    @property
+    def roots(self) -> dict[str, stats.Histogram]:
+        return self._roots
+
+    @property
+    def attrs(self) -> dict[str, stats.Histogram]:
+        return self._attrs
+
+    @property
+    def slowest(self) -> list[tuple[int, str]]:
+        return sorted(self._slowest, reverse=True)
+
+    @property
+    def over(self) -> list[tuple[int, str]]:
+        """Files taking longer than the threshold."""
+        return self._over
+
+    def add(self, root: str, file: str, ns: int) -> None:
+        self._roots.setdefault(root, stats.Histogram()).add(ns)
+        self._attrs.setdefault(os.path.basename(file), stats.Histogram()).add(ns)
+        if len(self._slowest) < self._top:
+            heapq.heappush(self._slowest, (ns, file))
+        elif ns > self._slowest[0][0]:
+            heapq.heapreplace(self._slowest, (ns, file))
+        if ns > self._slow_ns:
+            self._over.append((ns, file))
+
+    def merge(self, other: ReadStats) -> None:
+        for mine, theirs in ((self._roots, other._roots), (self._attrs, other._attrs)):
+            for key, histogram in theirs.items():
+                mine.setdefault(key, stats.Histogram()).merge(histogram)
+        for item in other._slowest:
+            if len(self._slowest) < self._top:
+                heapq.heappush(self._slowest, item)
+            elif item > self._slowest[0]:
+                heapq.heapreplace(self._slowest, item)
+        self._over.extend(other._over)
+
+
+def consume_dirs(spec: TreeSpec, work: multiprocessing.Queue, pending: multiprocessing.Value, index: InodeIndex,
+                 read_stats: ReadStats, conn: multiprocessing.connection.Connection) -> None:
+    """Walk directories from the shared queue, and donate some of ours back whenever it runs dry."""
+    matcher = Matcher(spec)
+    # os.access() always says yes to root, even for write-only attributes.
+    root_user = os.geteuid() == 0
+    # We only take a directory from others when running out of our own.
+    stack = []
+    counts: dict[str, int] = {}
+    save_errors: dict[str, int] = {}
+    start = time.monotonic()
+    start_ns = time.monotonic_ns()
+    while True:
+        if not stack:
+            try:
+                stack.append(work.get(timeout=0.01))
+            except queue.Empty:
+                if pending.value == 0:
+                    break
+                continue
+
+        root, path = stack.pop()
+        dir_begin = time.monotonic_ns()
+        subdirs = []
+        try:
+            entries = list(os.scandir(path))
+        except OSError as e:
+            # Things like processes come and go.
+            if not matcher.allow(path, e.errno):
+                print(f'- Error: {path} - {e}', file=sys.stderr)
+                save_errors[path] = e.errno
+            entries = []
+
+        for entry in entries:
+            if matcher.skip(entry.name):
+                continue
+
+            try:
+                is_dir = entry.is_dir(follow_symlinks=spec.follow)
+                if is_dir:
+                    if index.add(entry.stat(follow_symlinks=spec.follow)):
+                        subdirs.append((root, entry.path))
+                    continue
+                if not entry.is_file(follow_symlinks=False):
+                    continue
+            except FileNotFoundError:
+                continue
+
+            if root_user and not entry.stat(follow_symlinks=False).st_mode & 0o444:
+                continue
+
+            if os.access(entry.path, os.R_OK):
+                counts[root] = counts.get(root, 0) + 1
+                begin = time.perf_counter_ns()
+                try:
+                    # we might get decoding errors without 'b'.
+                    with open(entry.path, 'rb') as f:
+                        f.read()
+                except OSError as e:
+                    if not matcher.allow(entry.path, e.errno):
+                        print(f'- Error: {entry.path} - {e}', file=sys.stderr)
+                        save_errors[entry.name] = e.errno
+                finally:
+                    # A slow show() callback is a bug even when it fails.
+                    read_stats.add(root, entry.path, time.perf_counter_ns() - begin)
+
+        trace.record(root, dir_begin, time.monotonic_ns())
+        # The parent is done only after its children are accounted for, so "pending" won't hit 0 too early.
+        with pending.get_lock():
+            pending.value += len(subdirs) - 1
+        stack.extend(subdirs)
+        if len(stack) > 1 and work.empty():
+            half = len(stack) // 2
+            for item in stack[:half]:
+                work.put(item)
+            del stack[:half]
+
+    trace.record('tree.consume_dirs', start_ns, time.monotonic_ns())
+    conn.send((counts, save_errors, read_stats, time.monotonic() - start, trace.export()))
+    conn.close()
+
+
+def read_trees(spec: TreeSpec, watchdog: meta.Watchdog) -> None:
+    """Read every file under the roots with a pool of workers, and fail on unexpected errors or slow reads."""
+    top = meta.param(f'{spec.name}.top', 10)
+    slow_ms = meta.param(f'{spec.name}.slow_ms', 1000.0)
+    read_stats = ReadStats(top=top, slow_ns=int(slow_ms * 1000000))
+    index = InodeIndex(meta.param(f'{spec.name}.inodes', 1 << 20))
+    work = multiprocessing.Queue()
+    pending = multiprocessing.Value('l', 0)
+    for root_path in spec.roots:
+        if index.add(os.stat(root_path)):
+            print(f'- Read files in {root_path}.')
+            work.put((root_path, root_path))
+            pending.value += 1
+
+    # The number of workers depends on the CPUs we can use instead of how many roots there are.
+    nr_workers = len(os.sched_getaffinity(0))
+    proc_map = {}
+    for _ in range(nr_workers):
+        reader, writer = multiprocessing.Pipe(duplex=False)
+        proc = multiprocessing.Process(target=consume_dirs, daemon=True,
+                                       kwargs={'spec': spec, 'work': work, 'pending': pending, 'index': index,
+                                               'read_stats': read_stats, 'conn': writer})
+        proc.start()
+        writer.close()
+        proc_map[proc] = reader
+
+    counts: dict[str, int] = {}
+    save_errors: dict[str, int] = {}
+    for nr_worker, (proc, reader) in enumerate(proc_map.items()):
+        try:
+            worker_counts, worker_errors, worker_stats, elapsed, spans = reader.recv()
+        except EOFError:
+            raise OSError(f'worker {nr_worker} exited with {proc.exitcode} before sending its results.')
+        finally:
+            proc.join()
+
+        total = sum(worker_counts.values())
+        print(f'- Worker {nr_worker} read {total} files in {elapsed:.3f}s '
+              f'({total / elapsed if elapsed else 0:.0f} files/s).')
+        for root_path, count in worker_counts.items():
+            counts[root_path] = counts.get(root_path, 0) + count
+        save_errors.update(worker_errors)
+        read_stats.merge(worker_stats)
+        trace.merge(spans)
+
+    for root_path in spec.roots:
+        print(f'- Finish reading {root_path} for {counts.get(root_path, 0)} files.')
+        if root_path in read_stats.roots:
+            print(f'  {read_stats.roots[root_path]}')
+
+    print(f'- The {top} slowest files:')
+    for ns, file in read_stats.slowest:
+        print(f'  {ns / 1000000:.3f} ms: {file} ({read_stats.attrs[os.path.basename(file)]})')
+
+    watchdog.metrics['files'] = sum(counts.values())
+    watchdog.metrics['roots'] = counts
+    watchdog.metrics['max_read_ms'] = read_stats.slowest[0][0] / 1000000 if read_stats.slowest else 0
+    for ns, file in read_stats.over:
+        print(f'- Error: {file} took {ns / 1000000:.3f} ms over {slow_ms} ms.', file=sys.stderr)
+
+    for file in save_errors:
+        print(f'- {file}: {os.strerror(save_errors[file])}')
+
+    if save_errors:
+        raise OSError(f'Caught the above exceptions.')
+
+    if read_stats.over:
+        raise OSError(f'{len(read_stats.over)} files are slower than {slow_ms} ms to read.')
+
+
+def list_files(spec: TreeSpec) -> list[str]:
+    """Return all readable files under the roots in one go, with the same rules as read_trees()."""
+    matcher = Matcher(spec)
+    files = []
+    for root_path in spec.roots:
+        for root, dirs, names in os.walk(root_path):
+            dirs[:] = [entry for entry in dirs if not matcher.skip(entry)]
+            for entry in names:
+                file = os.path.join(root, entry)
+                if matcher.skip(entry) or not os.access(file, os.R_OK) or not os.stat(file).st_mode & 0o444:
+                    continue
+                files.append(file)
+
+    return files
+
+
+def hammer_file(conn: multiprocessing.connection.Connection) -> None:
+    """Read the same file over and over from the start in a time window given by the main process."""
+    while (command := conn.recv()) is not None:
+        file, start_ns, end_ns = command
+        count = 0
+        max_ns = 0
+        fd = os.open(file, os.O_RDONLY)
+        try:
+            # Line up with the other readers.
+            while time.monotonic_ns() < start_ns:
+                pass
+            now = time.monotonic_ns()
+            while now < end_ns:
+                try:
+                    os.pread(fd, 4096, 0)
+                except OSError:
+                    pass
+                begin, now = now, time.monotonic_ns()
+                max_ns = max(max_ns, now - begin)
+                count += 1
+        finally:
+            os.close(fd)
+        conn.send((count, max_ns))
+
+
+def stress_files(files: list[str], nr_readers: int, window: float, collapse: float, stall_ms: float) -> list[str]:
+    """Read each file from 1, 2, 4... readers at the same time, and return those not scaling or stalling."""
+    levels = [1 << shift for shift in range(nr_readers.bit_length()) if 1 << shift < nr_readers] + [nr_readers]
+    readers = []
+    for _ in range(nr_readers):
+        conn, child_conn = multiprocessing.Pipe()
+        proc = multiprocessing.Process(target=hammer_file, args=(child_conn,), daemon=True)
+        proc.start()
+        child_conn.close()
+        readers.append((proc, conn))
+
+    bad = []
+    try:
+        for file in files:
+            rates = []
+            worst = 0
+            for level in levels:
+                # Leave enough time for all readers to get the command.
+                start_ns = time.monotonic_ns() + 2000000
+                for _, conn in readers[:level]:
+                    conn.send((file, start_ns, start_ns + int(window * 1e9)))
+                replies = [conn.recv() for _, conn in readers[:level]]
+                rates.append(sum(count for count, _ in replies) / window)
+                worst = max([worst] + [max_ns for _, max_ns in replies])
+
+            scaling = ', '.join(f'{level}: {rate:.0f}/s' for level, rate in zip(levels, rates))
+            if rates[0] and max(rates[1:] or rates) < rates[0] * collapse:
+                print(f'- Error: {file} collapses under contention ({scaling}).', file=sys.stderr)
+                bad.append(file)
+            elif worst > stall_ms * 1000000:
+                print(f'- Error: {file} stalls for {worst / 1000000:.3f} ms ({scaling}).', file=sys.stderr)
+                bad.append(file)
+            else:
+                print(f'- {file}: {scaling}')
+    finally:
+        for proc, conn in readers:
+            conn.send(None)
+            proc.join()
+
+    return bad
@@ -2,7 +2,6 @@
 # SPDX-License-Identifier: GPL-2.0-or-later
 
 import os
-import re
 import typing
 
 from src import data
@@ -28,43 +27,41 @@ def parse_range(simple_range: str) -> tuple[int, int]:
     return int(start), int(end)
 
 
+def parse_selection(item: str) -> list[int]:
+    """Return test case numbers from a number, a range, a tag, a module or a function name."""
+    if item.lstrip('-').isdigit():
+        return [int(item)]
+
+    if item[:1].isdigit():
+        start, end = parse_range(item)
+        return list(range(start, end + 1))
+
+    numbers = data.Mapping.select(item)
+    if not numbers:
+        raise RuntimeError(f'No test case matches {item}.')
+
+    return numbers
+
+
 def merge_ranges(deny: list[str], allow: list[str]) -> list[int]:
     flat_list = []
     # We will run all tests if none is given.
     if not allow:
-        flat_list = range(1, data.Mapping.get_total() + 1)
+        flat_list = data.Mapping.entries()
 
     flat_set = set(flat_list)
     for item in allow:
-        if item.lstrip('-').isdigit():
-            flat_set.add(int(item))
-        else:
-            start, end = parse_range(item)
-            flat_set.update(range(start, end + 1))
+        flat_set.update(parse_selection(item))
 
     for item in deny:
-        if item.lstrip('-').isdigit():
-            flat_set.remove(int(item))
-        else:
-            start, end = parse_range(item)
-            flat_set.difference_update(range(start, end + 1))
+        flat_set.difference_update(parse_selection(item))
 
     return sorted(flat_set)
 
 
 def tail_cpu() -> int:
     """Return the last online CPU number."""
-    sysfs = '/sys/devices/system/cpu/'
-    nr_cpu = -1
-    for entry in os.listdir(sysfs):
-        if not re.match(r'cpu\d+', entry):
-            continue
-
-        # Whether CPU0 have the "online" file depends on the kernel config.
-        online_file = os.path.join(sysfs, entry, 'online')
-        if os.path.exists(online_file) and open(online_file).read().rstrip() == '1':
-            nr_cpu = max(nr_cpu, int(entry.lstrip('cpu')))
-
+    nr_cpu = topology().tail_cpu
     assert nr_cpu >= 0
     return nr_cpu
 
@@ -83,20 +80,193 @@ def parse_pair_file(file: str, sep: typing.Optional[str] = None) -> dict[str, st
     return pairs
 
 
-def tail_node() -> int:
-    """Return the last online NUMA node number including some memory."""
-    sysfs = '/sys/devices/system/node/'
-    nr_node = -1
-    for entry in os.listdir(sysfs):
-        if not re.match(r'node\d+', entry):
+def parse_cpulist(cpulist: str) -> list[int]:
+    """Return the numbers from a kernel list format like "0-3,8,10-11"."""
+    numbers = []
+    for item in cpulist.strip().split(','):
+        if not item:
             continue
+        if '-' in item:
+            start, end = parse_range(item)
+            numbers.extend(range(start, end + 1))
+        else:
+            numbers.append(int(item))
+
+    return numbers
+
+
+def to_mask(numbers: typing.Iterable[int]) -> int:
+    """Return a bitmap where bit N is set for each number N."""
+    mask = 0
+    for number in numbers:
+        mask |= 1 << number
+
+    return mask
+
+
+def from_mask(mask: int) -> list[int]:
+    """Return the numbers of all set bits in a bitmap."""
+    numbers = []
+    while mask:
+        low = mask & -mask
+        numbers.append(low.bit_length() - 1)
+        mask ^= low
+
+    return numbers
+
+
+class Topology:
+    """CPUs and NUMA nodes read once from sysfs and kept as bitmaps, where bit N stands for CPU or node N.
+
+    Two files stay open to tell a hotplug event by their content, so checking whether it is still valid is cheap.
+    """
+
+    cpu_sysfs: str = '/sys/devices/system/cpu'
+    node_sysfs: str = '/sys/devices/system/node'
+    # The sibling files in "topology" of each CPU.
+    levels: dict[str, str] = {
+        'core': 'core_cpus_list',
+        'cluster': 'cluster_cpus_list',
+        'die': 'die_cpus_list',
+        'package': 'package_cpus_list',
+    }
+
+    def __init__(self) -> None:
+        self._fds: list[int] = [os.open(os.path.join(self.cpu_sysfs, 'online'), os.O_RDONLY),
+                                os.open(os.path.join(self.node_sysfs, 'online'), os.O_RDONLY)]
+        self._state: list[bytes] = self.read_state()
+        self._online_cpus: list[int] = parse_cpulist(self._state[0].decode())
+        self._online_mask: int = to_mask(self._online_cpus)
+        self._node_masks: dict[str, int] = {'online': to_mask(parse_cpulist(self._state[1].decode()))}
+
+        self._node_cpus: dict[int, int] = {}
+        self._cpu_node: list[int] = [-1] * (max(self._online_cpus) + 1)
+        for nr_node in from_mask(self._node_masks['online']):
+            mask = to_mask(parse_cpulist(open(os.path.join(self.node_sysfs, f'node{nr_node}', 'cpulist')).read()))
+            self._node_cpus[nr_node] = mask
+            for nr_cpu in from_mask(mask & self._online_mask):
+                self._cpu_node[nr_cpu] = nr_node
+
+        self._siblings: dict[str, list[int]] = {}
+
+    def read_state(self) -> list[bytes]:
+        return [os.pread(fd, 4096, 0) for fd in self._fds]
+
+    @property
+    def stale(self) -> bool:
+        """Whether any CPU or node went online or offline since we read the topology."""
+        return self.read_state() != self._state
 
-        # Don't think we can have a CPU-less node, so just check the "local_node" number.
-        numastat = os.path.join(sysfs, entry, 'numastat')
-        pairs = parse_pair_file(file=numastat)
+    @property
+    def online_mask(self) -> int:
+        return self._online_mask
 
-        if int(pairs['local_node']) > 0:
-            nr_node = max(nr_node, int(entry.lstrip('node')))
+    @property
+    def online_cpus(self) -> list[int]:
+        return self._online_cpus
 
+    @property
+    def tail_cpu(self) -> int:
+        return self._online_mask.bit_length() - 1
+
+    @property
+    def tail_node(self) -> int:
+        """Return the last node including some memory."""
+        return self.node_mask('has_memory').bit_length() - 1
+
+    def is_online(self, nr_cpu: int) -> bool:
+        return bool(self._online_mask >> nr_cpu & 1)
+
+    def node_mask(self, state: str) -> int:
+        """Return nodes in a state like "has_memory" or "has_cpu" as a bitmap."""
+        if state not in self._node_masks:
+            self._node_masks[state] = to_mask(parse_cpulist(open(os.path.join(self.node_sysfs, state)).read()))
+
+        return self._node_masks[state]
+
+    def cpu_node(self, nr_cpu: int) -> int:
+        """Return the node of an online CPU, or -1 for an offline CPU."""
+        return self._cpu_node[nr_cpu] if nr_cpu < len(self._cpu_node) else -1
+
+    def node_cpus(self, nr_node: int) -> int:
+        """Return the online CPUs of a node as a bitmap."""
+        return self._node_cpus.get(nr_node, 0) & self._online_mask
+
+    def siblings(self, nr_cpu: int, level: str) -> int:
+        """Return the online CPUs sharing a core, cluster, die, package or last level "cache" with a CPU as a bitmap.
+
+        We only read the sysfs file of one CPU in each group, and share its bitmap with the rest of the group.
+        """
+        if level not in self._siblings:
+            self._siblings[level] = [0] * len(self._cpu_node)
+
+        groups = self._siblings[level]
+        if not groups[nr_cpu] and self.is_online(nr_cpu):
+            mask = self.read_cache(nr_cpu) if level == 'cache' else self.read_topology(nr_cpu, level)
+            mask &= self._online_mask
+            for sibling in from_mask(mask | 1 << nr_cpu):
+                groups[sibling] = mask | 1 << nr_cpu
+
+        return groups[nr_cpu]
+
+    def read_topology(self, nr_cpu: int, level: str) -> int:
+        path = os.path.join(self.cpu_sysfs, f'cpu{nr_cpu}', 'topology', self.levels[level])
+        # Old kernels don't know clusters, which is the same as one core per cluster then.
+        if not os.path.exists(path):
+            return 1 << nr_cpu
+
+        return to_mask(parse_cpulist(open(path).read()))
+
+    def read_cache(self, nr_cpu: int) -> int:
+        cache = os.path.join(self.cpu_sysfs, f'cpu{nr_cpu}', 'cache')
+        top_level = 0
+        mask = 1 << nr_cpu
+        for entry in os.listdir(cache) if os.path.isdir(cache) else []:
+            if not entry.startswith('index'):
+                continue
+
+            level = int(open(os.path.join(cache, entry, 'level')).read())
+            if level > top_level:
+                top_level = level
+                mask = to_mask(parse_cpulist(open(os.path.join(cache, entry, 'shared_cpu_list')).read()))
+
+        return mask
+
+    def close(self) -> None:
+        for fd in self._fds:
+            os.close(fd)
+
+
+_topology: typing.Optional[Topology] = None
+
+
+def topology() -> Topology:
+    """Return the topology of this run, which we only read again after a hotplug event."""
+    global _topology
+    if _topology is None or _topology.stale:
+        if _topology is not None:
+            _topology.close()
+        _topology = Topology()
+
+    return _topology
+
+
+def online_cpus() -> list[int]:
+    """Return all online CPU numbers."""
+    return list(topology().online_cpus)
+
+
+def nodes_with(state: str) -> list[int]:
+    """Return NUMA nodes in a state like "has_memory" or "has_cpu"."""
+    return from_mask(topology().node_mask(state))
+
+
+def node_cpus(nr_node: int) -> list[int]:
+    return from_mask(topology().node_cpus(nr_node))
+
+
+def tail_node() -> int:
+    """Return the last online NUMA node number including some memory."""
+    nr_node = topology().tail_node
     assert nr_node >= 0
     return nr_node
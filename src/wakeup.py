@@ -0,0 +1,105 @@
+# Copyright (c) 2022, Qualcomm Innovation Center, Inc. All rights reserved.
+# SPDX-License-Identifier: GPL-2.0-or-later
+
+import ctypes
+import ctypes.util
+import os
+import pickle
+import statistics
+import sys
+import time
+
+from src import meta
+from src import stats
+from src import utils
+
+TIMER_ABSTIME = 1
+
+_libc = ctypes.CDLL(name=ctypes.util.find_library('c'), use_errno=True)
+
+
+class Timespec(ctypes.Structure):
+    _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+
+def measure_wakeups(interval: int, count: int) -> stats.Histogram:
+    """Sleep until absolute deadlines like cyclictest, and record how late each wake-up is in ns."""
+    histogram = stats.Histogram()
+    deadline = Timespec()
+    pointer = ctypes.byref(deadline)
+    clock_nanosleep = _libc.clock_nanosleep
+    target = time.clock_gettime_ns(time.CLOCK_MONOTONIC) + interval
+    for _ in range(count):
+        deadline.tv_sec, deadline.tv_nsec = divmod(target, 1000000000)
+        err = clock_nanosleep(time.CLOCK_MONOTONIC, TIMER_ABSTIME, pointer, None)
+        now = time.clock_gettime_ns(time.CLOCK_MONOTONIC)
+        if err:
+            raise OSError(err, os.strerror(err))
+
+        histogram.add(max(0, now - target))
+        target += interval
+        # Don't let a long stall turn into a burst of back-to-back wake-ups.
+        if target < now:
+            target = now + interval
+
+    return histogram
+
+
+def spawn_timer(watchdog: meta.Watchdog, nr_cpu: int, interval: int, count: int, fifo: int) -> tuple[int, int]:
+    reader, writer = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(reader)
+        os.setpgid(0, 0)
+        os.sched_setaffinity(0, [nr_cpu])
+        if fifo:
+            os.sched_setscheduler(0, os.SCHED_FIFO, os.sched_param(fifo))
+        with os.fdopen(writer, 'wb') as f:
+            f.write(pickle.dumps(measure_wakeups(interval=interval, count=count)))
+        os._exit(os.EX_OK)
+
+    os.close(writer)
+    watchdog.add_child(pid)
+    return pid, reader
+
+
+def find_outliers(histograms: dict[int, stats.Histogram], factor: float, floor: int) -> list[int]:
+    """Return the CPUs whose p99 is both above the floor and a multiple of the median p99 of all CPUs."""
+    median = statistics.median(histogram.percentile(99) for histogram in histograms.values())
+    return [nr_cpu for nr_cpu, histogram in histograms.items()
+            if histogram.percentile(99) > max(floor, median * factor)]
+
+
+@meta.case(14, name='Measure scheduler wake-up latency.', timeout=60, tags=('cpu',), resources=('cpus',))
+def run_wakeup(watchdog: meta.Watchdog) -> None:
+    interval = meta.param('wakeup.interval_us', 1000) * 1000
+    count = int(meta.param('wakeup.seconds', 5.0) * 1e9 / interval)
+    # A real-time priority like cyclictest's "-p", which 0 leaves at the default policy.
+    fifo = meta.param('wakeup.fifo', 0)
+    timers = {nr_cpu: spawn_timer(watchdog=watchdog, nr_cpu=nr_cpu, interval=interval, count=count, fifo=fifo)
+              for nr_cpu in utils.online_cpus()}
+
+    histograms = {}
+    for nr_cpu, (pid, reader) in timers.items():
+        with os.fdopen(reader, 'rb') as f:
+            data = f.read()
+        watchdog.del_child(pid)
+        if not data:
+            raise OSError(f'The timer process {pid} on CPU {nr_cpu} died.')
+        histograms[nr_cpu] = pickle.loads(data)
+
+    total = stats.Histogram()
+    for nr_cpu, histogram in histograms.items():
+        print(f'- CPU {nr_cpu}: {histogram.count} wake-ups, p50 {histogram.percentile(50) / 1000:.1f} us, '
+              f'p99 {histogram.percentile(99) / 1000:.1f} us, max {histogram.max / 1000:.1f} us.')
+        total.merge(histogram)
+
+    watchdog.metrics['p99_us'] = total.percentile(99) / 1000
+    watchdog.metrics['max_us'] = total.max / 1000
+    outliers = find_outliers(histograms, factor=meta.param('wakeup.factor', 4.0),
+                             floor=meta.param('wakeup.floor_us', 100) * 1000)
+    for nr_cpu in outliers:
+        print(f'- Error: CPU {nr_cpu} wakes up late with p99 {histograms[nr_cpu].percentile(99) / 1000:.1f} us.',
+              file=sys.stderr)
+    if outliers:
+        raise OSError(f'Wake-up latency outliers on CPUs {outliers}.')
@@ -0,0 +1,211 @@
+# Copyright (c) 2022, Qualcomm Innovation Center, Inc. All rights reserved.
+# SPDX-License-Identifier: GPL-2.0-or-later
+
+from __future__ import annotations
+
+import os
+import pickle
+import select
+import signal
+import socket
+import struct
+import sys
+import time
+import typing
+
+from src import meta
+
+
+class Worker:
+    """The main process's view of a test case running in a forked worker."""
+
+    # Give the worker's own watchdog a chance to fire before we kill it from outside.
+    grace: float = 5
+
+    def __init__(self, pid: int, test_case: meta.TestCase, out_fd: int, err_fd: int, res_fd: int) -> None:
+        self._pid: int = pid
+        self._test_case: meta.TestCase = test_case
+        self._start: float = time.monotonic()
+        self._buffers: dict[int, bytearray] = {out_fd: bytearray(), err_fd: bytearray(), res_fd: bytearray()}
+        self._out_fd: int = out_fd
+        self._err_fd: int = err_fd
+        self._res_fd: int = res_fd
+        self._eof: set[int] = set()
+        self._timed_out: bool = False
+
+    @property
+    def pid(self) -> int:
+        return self._pid
+
+    @property
+    def test_case(self) -> meta.TestCase:
+        return self._test_case
+
+    @property
+    def fds(self) -> list[int]:
+        return [fd for fd in self._buffers if fd not in self._eof]
+
+    @property
+    def deadline(self) -> typing.Optional[float]:
+        if not self._test_case.timeout:
+            return None
+
+        return self._start + self._test_case.timeout + self.grace
+
+    @property
+    def done(self) -> bool:
+        if self._res_fd in self._eof:
+            return True
+
+        # Leftover grandchildren could hold the pipe open, so don't wait for EOF once we have the whole result.
+        res = self._buffers[self._res_fd]
+        return len(res) >= 8 and len(res) >= 8 + struct.unpack('Q', res[:8])[0]
+
+    def feed(self, fd: int) -> None:
+        data = os.read(fd, 65536)
+        if data:
+            self._buffers[fd] += data
+        else:
+            self._eof.add(fd)
+
+    def expire(self) -> bool:
+        deadline = self.deadline
+        if deadline is None or time.monotonic() < deadline:
+            return False
+
+        self._timed_out = True
+        return True
+
+    def wait(self) -> meta.TestResult:
+        """Block until the worker is finished or killed."""
+        while not self.done and not self.expire():
+            deadline = self.deadline
+            timeout = None if deadline is None else max(0.0, deadline - time.monotonic())
+            for fd in select.select(self.fds, [], [], timeout)[0]:
+                self.feed(fd)
+
+        return self.finish()
+
+    def finish(self) -> meta.TestResult:
+        # Kill the whole process group, so nothing from this test case is left behind.
+        try:
+            os.killpg(self._pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+
+        # Everything holding the pipes is dead now, so this won't block for long.
+        while fds := self.fds:
+            for fd in select.select(fds, [], [])[0]:
+                self.feed(fd)
+
+        for fd in self._buffers:
+            os.close(fd)
+
+        res = self._buffers[self._res_fd]
+        if self.done and len(res) >= 8:
+            result = pickle.loads(res[8:])
+        else:
+            result = meta.TestResult(name=self._test_case.name)
+            if self._timed_out:
+                result.error = f'killed after {time.monotonic() - self._start:.3f}s'
+            else:
+                result.error = 'the worker exited without a result'
+            result.phases['total'] = time.monotonic() - self._start
+
+        result.stdout = self._buffers[self._out_fd].decode(errors='replace')
+        result.stderr = self._buffers[self._err_fd].decode(errors='replace')
+        return result
+
+
+class ForkServer:
+    """A warm process that has finished all imports and forks one isolated worker per test case on request.
+
+    We fork the server before starting any threads, and hand it the pipes for each worker over a UNIX socket.
+    """
+
+    def __init__(self, test_cases: list[meta.TestCase]) -> None:
+        self._test_cases: list[meta.TestCase] = test_cases
+        self._sock, server_sock = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+        sys.stdout.flush()
+        sys.stderr.flush()
+        self._pid: int = os.fork()
+        if self._pid == 0:
+            self._sock.close()
+            try:
+                self.serve(server_sock)
+            finally:
+                os._exit(os.EX_OK)
+
+        server_sock.close()
+
+    @property
+    def pid(self) -> int:
+        return self._pid
+
+    def serve(self, sock: socket.socket) -> None:
+        # Let the kernel reap the workers, as the results come back over the pipes.
+        signal.signal(signal.SIGCHLD, signal.SIG_IGN)
+        while True:
+            msg, fds, _, _ = socket.recv_fds(sock, 4, 3)
+            if not msg:
+                return
+
+            index = struct.unpack('i', msg)[0]
+            pid = os.fork()
+            if pid == 0:
+                sock.close()
+                signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+                run_worker(self._test_cases[index], *fds)
+
+            # Do it on both sides to avoid racing with a kill from the main process.
+            try:
+                os.setpgid(pid, pid)
+            except OSError:
+                pass
+            for fd in fds:
+                os.close(fd)
+            sock.send(struct.pack('i', pid))
+
+    def submit(self, test_case: meta.TestCase) -> Worker:
+        out_r, out_w = os.pipe()
+        err_r, err_w = os.pipe()
+        res_r, res_w = os.pipe()
+        socket.send_fds(self._sock, [struct.pack('i', self._test_cases.index(test_case))], [out_w, err_w, res_w])
+        for fd in (out_w, err_w, res_w):
+            os.close(fd)
+
+        pid = struct.unpack('i', self._sock.recv(4))[0]
+        return Worker(pid=pid, test_case=test_case, out_fd=out_r, err_fd=err_r, res_fd=res_r)
+
+    def close(self) -> None:
+        self._sock.close()
+        os.waitpid(self._pid, 0)
+
+
+def run_worker(test_case: meta.TestCase, out_fd: int, err_fd: int, res_fd: int) -> typing.NoReturn:
+    try:
+        os.setpgid(0, 0)
+    except OSError:
+        pass
+
+    os.dup2(out_fd, sys.stdout.fileno())
+    os.dup2(err_fd, sys.stderr.fileno())
+    os.close(out_fd)
+    os.close(err_fd)
+
+    status = os.EX_SOFTWARE
+    try:
+        # A new watchdog only knows about this process, so a timeout won't kill anything else.
+        result = meta.execute(test_case, meta.Watchdog())
+        sys.stdout.flush()
+        sys.stderr.flush()
+
+        data = pickle.dumps(result)
+        with os.fdopen(res_fd, 'wb') as f:
+            f.write(struct.pack('Q', len(data)) + data)
+
+        if result.passed:
+            status = os.EX_OK
+    finally:
+        # Don't run anything inherited from the parent like atexit handlers.
+        os._exit(status)